@@ -11,3 +11,77 @@ def returnAudio(path):
     elif ext == ".ogg":
         audio = OggVorbis(path)
     return audio
+
+
+class Metadata(object):
+    """The tags of a song, parsed at most once and shared by everything
+    that reads or changes them.
+
+    Changes are only made in memory and remembered in `dirty`, a dict
+    from each changed tag to its new values, or None if it was deleted,
+    and `save` writes the file once, only if something changed.
+
+    Given `tags`, such as from a `musicCatalog.Catalog`, they are read
+    instead of the file, which is then only parsed to save changes."""
+
+    def __init__(self, path, tags=None):
+        self.path = path
+        self.tags = tags
+        self._audio = None
+        self.dirty = {}
+
+    @property
+    def audio(self):
+        if self._audio is None:
+            self._audio = returnAudio(self.path)
+        return self._audio
+
+    def saved(self):
+        """Get the tags as last saved, without parsing if possible."""
+        if self._audio is None and self.tags is not None:
+            return self.tags
+        return self.audio
+
+    def __contains__(self, key):
+        if key in self.dirty:
+            return self.dirty[key] is not None
+        return key in self.saved()
+
+    def __getitem__(self, key):
+        if key in self.dirty:
+            if self.dirty[key] is None:
+                raise KeyError(key)
+            return self.dirty[key]
+        return self.saved()[key]
+
+    def __setitem__(self, key, value):
+        values = value if isinstance(value, list) else [value]
+        if key not in self or self[key] != values:
+            self.dirty[key] = values
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.dirty[key] = None
+
+    def keys(self):
+        return [k for k in set(self.saved().keys()) | set(self.dirty)
+                if k in self]
+
+    def asDict(self):
+        """Get the tags as a dict of lists, as cataloged."""
+        return dict((k, list(self[k])) for k in self.keys())
+
+    def save(self):
+        """Write the changed tags, returning whether there were any."""
+        if not self.dirty:
+            return False
+        audio = self.audio
+        for key, values in self.dirty.items():
+            if values is None:
+                del audio[key]
+            else:
+                audio[key] = values
+        audio.save()
+        self.dirty = {}
+        return True
@@ -5,54 +5,353 @@ __date__ = '2015.08.10'
 
 """
 This script computes the mean of a directory of images for Caffe.
+
+Images are decoded and summed in chunks by a pool of `--jobs` processes
+and the partial sums are added up at the end.
+
+In the same pass, the per-channel standard deviation is saved to
+`<meanPrefix>-std.npy`, and the image count and per-channel mean and
+standard deviation over all images and for each class (the image's
+directory name) to `<meanPrefix>-stats.csv`.
+
+Progress over the sorted list of images is checkpointed to
+`<meanPrefix>.checkpoint` every `--checkpointImages` images or
+`--checkpointSeconds` seconds, and a restarted run resumes from it.
+Separate runs can each take a `--shard K/N` of the images, checkpointed
+to `<meanPrefix>.<K>-of-<N>.checkpoint`, and the checkpoints of all `N`
+shards of the same images are combined into the mean files with
+`--merge`.
+
+Images are resized to `--size` if needed. With `--pack`, the resized
+images are also written to a .npy array that later stages can memory
+map instead of decoding the images again.
 """
 
 import sys
 sys.path.append("/home/bamos/repos/caffe-local/python")
 
 import argparse
+import csv
+import functools
+import hashlib
+import itertools
+import multiprocessing
 import numpy as np
 import os
+import pickle
 import time
 
 from caffe.io import array_to_blobproto
 from collections import defaultdict
-from skimage import io
+from skimage import img_as_ubyte, io, transform
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('meanPrefix', type=str, help="Prefix of the mean file.")
-    parser.add_argument('imageDir', type=str, help="Directory of images to read.")
-    args = parser.parse_args()
 
+def getImgs(imageDir):
+    """Get the `(imageClass, path)` pairs of the images in `imageDir`, in
+    sorted order."""
     exts = ["jpg", "png"]
-
-    mean = np.zeros((1, 3, 152, 152))
-    N = 0
-    classSizes = defaultdict(int)
-
-    beginTime = time.time()
-    for subdir, dirs, files in os.walk(args.imageDir):
+    imgs = []
+    for subdir, dirs, files in os.walk(imageDir):
         for fName in files:
             (imageClass, imageName) = (os.path.basename(subdir), fName)
             if any(imageName.lower().endswith("." + ext) for ext in exts):
-                img = io.imread(os.path.join(subdir, fName))
-                if img.shape == (152, 152, 3):
-                    mean[0][0] += img[:, :, 0]
-                    mean[0][1] += img[:, :, 1]
-                    mean[0][2] += img[:, :, 2]
-                    N += 1
-                    if N % 1000 == 0:
-                        elapsed = time.time() - beginTime
-                        print("Processed {} images in {:.2f} seconds. "
-                              "{:.2f} images/second.".format(N, elapsed,
-                                                             N / elapsed))
-    mean[0] /= N
+                imgs.append((imageClass, os.path.join(subdir, fName)))
+    return sorted(imgs, key=lambda img: img[1])
+
+
+def channelStats(hist):
+    """Get the per-channel mean and standard deviation of the pixels
+    counted in a (3, 256) histogram."""
+    values = np.arange(256)
+    n = hist.sum(axis=1).astype(np.float64)
+    mean = hist.dot(values) / n
+    var = (hist * np.square(values - mean[:, None])).sum(axis=1) / n
+    return mean, np.sqrt(var)
+
+
+class ImageStats(object):
+    """The pixel sums of `size`x`size` RGB images in Caffe's channels-first
+    layout, with per-channel histograms of their pixels over all images
+    and by class.
+
+    Both are exact, so partial stats can be merged in any order, and the
+    standard deviation comes from the histogram without the cancellation
+    of summing squares."""
+
+    def __init__(self, size=152):
+        self.N = 0
+        self.total = np.zeros((3, size, size))
+        self.hist = np.zeros((3, 256), dtype=np.int64)
+        self.classSizes = defaultdict(int)
+        self.classHists = {}
+
+    def add(self, imageClass, img):
+        self.total += img.transpose(2, 0, 1)
+        self.N += 1
+        hist = np.array([np.bincount(img[:, :, c].ravel(), minlength=256)
+                         for c in range(3)])
+        self.hist += hist
+        self.addClass(imageClass, 1, hist)
+
+    def addClass(self, imageClass, n, hist):
+        self.classSizes[imageClass] += n
+        if imageClass in self.classHists:
+            self.classHists[imageClass] += hist
+        else:
+            self.classHists[imageClass] = hist.copy()
+
+    def merge(self, other):
+        self.total += other.total
+        self.N += other.N
+        self.hist += other.hist
+        for imageClass, hist in other.classHists.items():
+            self.addClass(imageClass, other.classSizes[imageClass], hist)
+
+
+def loadImg(imgPath, size=152):
+    """Read an image as a `size`x`size` RGB uint8 array, resizing it,
+    scaling it to 8 bits, and converting it from gray or dropping its
+    alpha channel if needed.
+
+    Returns None for images with any other number of channels."""
+    img = io.imread(imgPath)
+    if img.dtype != np.uint8:
+        # Such as 16-bit PNGs, whose values don't fit the histograms.
+        img = img_as_ubyte(img)
+    if img.ndim == 2:
+        img = np.dstack([img] * 3)
+    if img.ndim != 3 or img.shape[2] not in (3, 4):
+        return None
+    img = img[:, :, :3]
+    if img.shape[:2] != (size, size):
+        img = transform.resize(img, (size, size), preserve_range=True)
+        img = img.round().astype(np.uint8)
+    return img
+
+
+def statImgs(chunk, size=152, packPath=None):
+    """Get the `ImageStats` of a chunk of images at `size`.
+
+    `chunk` is `(start, imgs)`, where `imgs` is a list of `(imageClass,
+    path)` pairs starting at row `start` of the packed array at
+    `packPath`, if given. The images read are written to their rows, and
+    the list of those rows is returned with the stats."""
+    start, imgs = chunk
+    stats = ImageStats(size)
+    pack = np.load(packPath, mmap_mode='r+') if packPath else None
+    packed = []
+    for i, (imageClass, imgPath) in enumerate(imgs):
+        img = loadImg(imgPath, size)
+        if img is not None:
+            stats.add(imageClass, img)
+            if pack is not None:
+                pack[start + i] = img
+                packed.append(start + i)
+    if pack is not None:
+        pack.flush()
+    return stats, packed
+
+
+def listDigest(imgs, size):
+    """Get a digest identifying a list of `(imageClass, path)` pairs read
+    at `size`."""
+    return hashlib.sha1("{}\n".format(size) + "\n".join(
+        path for _, path in imgs)).hexdigest()
+
+
+def saveCheckpoint(path, checkpoint):
+    """Atomically save a checkpoint dict to `path`."""
+    tmpPath = path + ".tmp"
+    with open(tmpPath, 'wb') as f:
+        pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpPath, path)
+
+
+def loadCheckpoint(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def saveStats(meanPrefix, stats):
+    """Save the mean of `stats` for Caffe along with the std and stats."""
+    N = stats.N
+    mean = (stats.total / N)[np.newaxis]
 
     blob = array_to_blobproto(mean)
-    with open("{}.binaryproto".format(args.meanPrefix), 'wb') as f:
+    with open("{}.binaryproto".format(meanPrefix), 'wb') as f:
         f.write(blob.SerializeToString())
-    np.save("{}.npy".format(args.meanPrefix), mean[0])
+    np.save("{}.npy".format(meanPrefix), mean[0])
 
     meanImg = np.transpose(mean[0].astype(np.uint8), (1, 2, 0))
-    io.imsave("{}.png".format(args.meanPrefix), meanImg)
+    io.imsave("{}.png".format(meanPrefix), meanImg)
+
+    np.save("{}-std.npy".format(meanPrefix), channelStats(stats.hist)[1])
+    with open("{}-stats.csv".format(meanPrefix), 'wb') as f:
+        w = csv.writer(f)
+        w.writerow(["class", "images"] + [
+            "{}{}".format(stat, c) for stat in ("mean", "std")
+            for c in range(3)])
+        rows = [("", N, stats.hist)] + [
+            (imageClass, stats.classSizes[imageClass], hist)
+            for imageClass, hist in sorted(stats.classHists.items())]
+        for imageClass, n, hist in rows:
+            mean, std = channelStats(hist)
+            w.writerow([imageClass, n] + list(mean) + list(std))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('meanPrefix', type=str, help="Prefix of the mean file.")
+    parser.add_argument('imageDir', type=str, nargs='?',
+                        help="Directory of images to read.")
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help="Number of processes to decode images with.")
+    parser.add_argument('--chunkSize', type=int, default=1000,
+                        help="Number of images each process sums at a time.")
+    parser.add_argument('--size', type=int, default=152,
+                        help="Side of the square images to average. Images "
+                        "of other sizes are resized.")
+    parser.add_argument('--pack', type=str, metavar='NPY',
+                        help="Also write the resized images to this "
+                        "memory-mappable .npy array, with one (size, size, 3) "
+                        "uint8 row per image, and an index of the rows "
+                        "written to NPY.index.")
+    parser.add_argument('--checkpoint', type=str,
+                        help="Checkpoint to save progress to and resume "
+                        "from. Default: <meanPrefix>.checkpoint, or "
+                        "<meanPrefix>.<K>-of-<N>.checkpoint with --shard.")
+    parser.add_argument('--checkpointImages', type=int, default=50000,
+                        help="Save a checkpoint every this many images.")
+    parser.add_argument('--checkpointSeconds', type=float, default=600,
+                        help="Save a checkpoint every this many seconds.")
+    parser.add_argument('--shard', type=str, metavar='K/N',
+                        help="Only process the K-th of N shards of the "
+                        "sorted images, leaving the result in the "
+                        "checkpoint for --merge.")
+    parser.add_argument('--merge', type=str, nargs='+', metavar='CHECKPOINT',
+                        help="Save the mean of the finished checkpoints of "
+                        "every shard of the same images instead of reading "
+                        "images.")
+    args = parser.parse_args()
+
+    if args.merge:
+        stats = None
+        shards = {}  # Shard number -> checkpoint path.
+        shardsOf = None  # (N, digest of the full list of images).
+        for path in args.merge:
+            checkpoint = loadCheckpoint(path)
+            if checkpoint.get('shard') is None:
+                print("Error: {} isn't a shard checkpoint.".format(path))
+                sys.exit(-1)
+            (k, n), digest = checkpoint['shard'], checkpoint['listDigest']
+            if shardsOf and (n, digest) != shardsOf:
+                print("Error: {} is shard {}/{} of a different list of "
+                      "images than {}.".format(path, k, n, args.merge[0]))
+                sys.exit(-1)
+            shardsOf = (n, digest)
+            if k in shards:
+                print("Error: {} and {} are both shard {}/{}.".format(
+                    shards[k], path, k, n))
+                sys.exit(-1)
+            shards[k] = path
+            if checkpoint['cursor'] < checkpoint['size']:
+                print("Error: {} is only {} of {} images through.".format(
+                    path, checkpoint['cursor'], checkpoint['size']))
+                sys.exit(-1)
+            if stats is None:
+                stats = checkpoint['stats']
+            else:
+                stats.merge(checkpoint['stats'])
+        missing = sorted(set(range(1, n + 1)) - set(shards))
+        if missing:
+            print("Error: Missing shards {} of {}.".format(
+                ", ".join(map(str, missing)), n))
+            sys.exit(-1)
+        saveStats(args.meanPrefix, stats)
+        sys.exit(0)
+    if not args.imageDir:
+        parser.error("imageDir is required unless merging.")
+
+    imgs = getImgs(args.imageDir)
+    shard = None
+    checkpointPath = args.checkpoint or "{}.checkpoint".format(args.meanPrefix)
+    if args.shard:
+        k, n = map(int, args.shard.split('/'))
+        if not 1 <= k <= n:
+            parser.error("--shard K/N needs 1 <= K <= N.")
+        shard = (k, n)
+        allDigest = listDigest(imgs, args.size)
+        imgs = imgs[(k - 1) * len(imgs) // n:k * len(imgs) // n]
+        checkpointPath = args.checkpoint or "{}.{}-of-{}.checkpoint".format(
+            args.meanPrefix, k, n)
+    # A shard's checkpoint also records which shard of which list of
+    # images it is, so --merge can check it has every shard once.
+    checkpoint = {'digest': listDigest(imgs, args.size), 'size': len(imgs),
+                  'cursor': 0, 'stats': ImageStats(args.size),
+                  'pack': args.pack, 'packed': [], 'shard': shard,
+                  'listDigest': allDigest if shard else None}
+    if os.path.exists(checkpointPath):
+        saved = loadCheckpoint(checkpointPath)
+        if saved['digest'] != checkpoint['digest']:
+            print("Error: {} is for a different list of images. "
+                  "Remove it to start over.".format(checkpointPath))
+            sys.exit(-1)
+        if saved['pack'] != args.pack:
+            print("Error: {} was packing to {}, not {}.".format(
+                checkpointPath, saved['pack'], args.pack))
+            sys.exit(-1)
+        # Shard checkpoints saved before they recorded their shard.
+        saved.setdefault('shard', shard)
+        saved.setdefault('listDigest', checkpoint['listDigest'])
+        checkpoint = saved
+        print("Resuming from {} after {} of {} images.".format(
+            checkpointPath, checkpoint['cursor'], checkpoint['size']))
+
+    if args.pack and checkpoint['cursor'] == 0:
+        np.lib.format.open_memmap(args.pack, 'w+', np.uint8,
+                                  (len(imgs), args.size, args.size, 3))
+
+    # Chunks are merged in order, so the images before the cursor are done.
+    chunks = [(i, imgs[i:i + args.chunkSize])
+              for i in range(checkpoint['cursor'], len(imgs), args.chunkSize)]
+    statChunk = functools.partial(statImgs, size=args.size,
+                                  packPath=args.pack)
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    if pool:
+        partialStats = pool.imap(statChunk, chunks)
+    else:
+        partialStats = itertools.imap(statChunk, chunks)
+
+    stats = checkpoint['stats']
+    startN = stats.N
+    beginTime = time.time()
+    lastCheckpoint = (checkpoint['cursor'], beginTime)
+    for (_, chunk), (partial, packed) in itertools.izip(chunks, partialStats):
+        stats.merge(partial)
+        checkpoint['packed'].extend(packed)
+        checkpoint['cursor'] += len(chunk)
+        now = time.time()
+        elapsed = now - beginTime
+        print("Processed {} images in {:.2f} seconds. "
+              "{:.2f} images/second.".format(stats.N, elapsed,
+                                             (stats.N - startN) / elapsed))
+        if checkpoint['cursor'] - lastCheckpoint[0] >= args.checkpointImages \
+                or now - lastCheckpoint[1] >= args.checkpointSeconds:
+            saveCheckpoint(checkpointPath, checkpoint)
+            lastCheckpoint = (checkpoint['cursor'], now)
+    if pool:
+        pool.close()
+        pool.join()
+
+    if args.pack:
+        with open("{}.index".format(args.pack), 'w') as f:
+            for row in checkpoint['packed']:
+                f.write("{}\t{}\t{}\n".format(row, *imgs[row]))
+
+    if args.shard:
+        saveCheckpoint(checkpointPath, checkpoint)
+        print("Saved shard {} to {}.".format(args.shard, checkpointPath))
+    else:
+        saveStats(args.meanPrefix, stats)
+        if os.path.exists(checkpointPath):
+            os.remove(checkpointPath)
@@ -5,6 +5,9 @@ __date__ = '2015.12.30'
 
 """
 This script (fix-music-tags.py) mass-removes unwanted music tags.
+
+Songs are looked up in the `musicCatalog` of the collection the directory
+is in first, and only songs with tags to change are parsed and saved.
 """
 
 from mutagen.easyid3 import EasyID3
@@ -15,17 +18,16 @@ import glob
 import re
 import tracknumber 
 import audioFunction
+import musicCatalog
 
-def fixTags(fname, keep):
-    audio = audioFunction.returnAudio(fname)
+def fixTags(meta, keep):
     delKeys = []
-    for k, v in audio.items():
+    for k in meta.keys():
         if k not in keep:
             delKeys.append(k)
 
     for k in delKeys:
-        del audio[k]
-    audio.save()
+        del meta[k]
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -35,6 +37,12 @@ if __name__ == '__main__':
             help="Tags to keep. Default: title, artist, album, genre")
     parser.add_argument('--fixnumber', action='store_true',
             help="Trying to fix song number.")
+    parser.add_argument('--library', type=str, default='.',
+            help="The music collection the directory is in, whose "
+            "catalog is shared with the other music scripts. Default: .")
+    parser.add_argument('--catalog', type=str,
+            help="Catalog of the songs' tags. Default: <library>/" +
+            musicCatalog.defaultName)
     args = parser.parse_args()
 
     types = ('*.mp3', '*.ogg')
@@ -44,8 +52,14 @@ if __name__ == '__main__':
             glob.glob("{}/*{}".format(args.directory, files))
         )
 
+    catalog = musicCatalog.Catalog(args.library, args.catalog)
+    catalog.update(files_grabbed)
     for fname in files_grabbed: 
         print("Fixing tags for {}".format(fname))
-        fixTags(fname, args.keep)
+        meta = audioFunction.Metadata(fname, catalog.tags(fname))
+        fixTags(meta, args.keep)
         if args.fixnumber:
-            tracknumber.formatNumber(fname)
+            tracknumber.formatNumber(meta)
+        if meta.save():
+            catalog.put(fname, meta.asDict())
+    catalog.close()
@@ -6,17 +6,91 @@ __date__ = '2015.04.09'
 """
 This script (music-autoplaylists.py) automatically creates
 M3U playlists from the genre ID3 tags of songs in a directory.
+
+Playlists can be made for any number of facets in the same run: genre,
+album, artist, year, and combinations of them such as `artist+album`.
+With more than one facet, each facet's playlists go in a subdirectory
+of the playlist directory named after it.
+
+The tags are read from a `musicCatalog` in the music directory, which
+only rereads the songs that changed since the last run. Only the
+playlists that changed are rewritten, each to a temporary file that is
+renamed over the old one, and only the playlists that are gone are
+deleted.
 """
 
 import argparse
 import os
 import re
-import shutil
 import sys
-from mutagen.easyid3 import EasyID3
 from collections import defaultdict
+import musicCatalog
 import toNeat
 
+# The tag each facet is read from.
+facetTags = {'genre': 'genre', 'album': 'album', 'artist': 'artist',
+             'year': 'date'}
+
+def facet(s):
+    """Check a facet argument, such as 'genre' or 'artist+album'."""
+    for name in s.split('+'):
+        if name not in facetTags:
+            raise argparse.ArgumentTypeError(
+                "Unknown facet '{}'. Choose from {}, joined with '+'.".format(
+                    name, ", ".join(sorted(facetTags))))
+    return s
+
+def facetTitles(tags, facet, args, errors):
+    """Get the titles of the playlists of `facet` a song with `tags`
+    belongs in, one for each combination of its values.
+
+    Values with unrecognized characters are left out and appended to
+    `errors`, and if all of a tag's values are left out, the song isn't
+    in any of the facet's playlists. Songs without the tag are in the
+    'Unknown' playlist."""
+    titles = [""]
+    for name in facet.split('+'):
+        values = tags.get(facetTags[name], [])
+        if name == 'year':
+            values = [v[:4] for v in values]
+        neatValues = toNeat.toNeatAll(
+            [v.encode('ascii', 'ignore') for v in values], args, errors)
+        accepted = [v for v in neatValues if v is not None]
+        if values and not accepted:
+            return []
+        neatValues = [v for v in accepted if v] or ['Unknown']
+        titles = [t + "+" + v if t else v for t in titles for v in neatValues]
+    return titles
+
+def writePlaylists(playlistDir, playlists):
+    """Write `playlists`, a dict from titles to song paths, to M3U files
+    in `playlistDir`, leaving the unchanged ones alone and deleting the
+    M3U files of titles not in `playlists`."""
+    if not os.path.isdir(playlistDir):
+        os.makedirs(playlistDir)
+    existing = set(os.path.splitext(f)[0] for f in os.listdir(playlistDir)
+                   if f.endswith('.m3u'))
+
+    for title, songs in sorted(playlists.items()):
+        p = os.path.join(playlistDir, title + '.m3u')
+        content = "#EXTM3U\n" + "\n".join(sorted(songs)) + "\n"
+        if title in existing:
+            with open(p) as f:
+                if f.read() == content:
+                    continue
+            print("Updating playlist: {}".format(p))
+        else:
+            print("Creating playlist: {}".format(p))
+        tmpPath = p + '.tmp'
+        with open(tmpPath, 'w') as f:
+            f.write(content)
+        os.rename(tmpPath, p)
+
+    for title in sorted(existing - set(playlists)):
+        p = os.path.join(playlistDir, title + '.m3u')
+        print("Removing playlist: {}".format(p))
+        os.remove(p)
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--musicDir', type=str, default='.')
@@ -24,43 +98,33 @@ def main():
     parser.add_argument('-a','--album', action='store_true', help='''Album mode''')
     parser.add_argument('-g','--genre', action='store_true', help='''Genre mode''')
     parser.add_argument('-C','--capital', action='store_true', help='''Changes names to capital''')
+    parser.add_argument('-f','--facet', type=facet, action='append', default=[], dest='facets', help='''Make playlists for this facet: genre, album, artist, year, or a combination such as artist+album. Can be repeated.''')
+    parser.add_argument('--catalog', type=str, help='''Catalog of the songs' tags. Default: <musicDir>/''' + musicCatalog.defaultName)
+    parser.add_argument('-j','--jobs', type=int, default=8, help='''Number of threads to read changed tags with''')
     args = parser.parse_args()
 
-    titleList = defaultdict(list)
-    
-    for dpath, dnames, fnames in os.walk(args.musicDir):
-        if '.git' in dpath:
-            continue
-        for fname in fnames:
-            if os.path.splitext(fname)[1] != '.mp3':
-                continue
-            p = os.path.abspath(os.path.join(dpath, fname))
-            audio = EasyID3(p)
-            if args.genre:
-                if 'genre' in audio:
-                    assert(len(audio['genre']) == 1)
-                    title = toNeat.toNeat(str(audio['genre'][0]), args)
-                else:
-                    title = 'Unknown'
-                titleList[title].append(p)
-            elif args.album:
-                if 'album' in audio:
-                    assert(len(audio['album']) == 1)
-                    title = toNeat.toNeat(str(audio['album'][0]), args) 
-                else:
-                    title = 'Unknown'
-                titleList[title].append(p)
-
-    if os.path.exists(args.playlistDir):
-        shutil.rmtree(args.playlistDir)
-    os.makedirs(args.playlistDir)
-
-    for titleList, songs in titleList.items():
-        p = os.path.join(args.playlistDir, title + '.m3u')
-        print("Creating playlist: {}".format(p))
-        with open(p, 'w') as f:
-            f.write("#EXTM3U\n")
-            f.write("\n".join(sorted(songs)) + "\n")
+    facets = args.facets + ['genre'] * args.genre + ['album'] * args.album
+    if not facets:
+        parser.error("Give at least one of --genre, --album or --facet.")
+
+    playlists = dict((f, defaultdict(set)) for f in facets)
+    catalog = musicCatalog.Catalog(args.musicDir, args.catalog)
+    catalog.update(jobs=args.jobs)
+    errors = []
+    for p, tags in catalog.songs():
+        for f in facets:
+            for title in facetTitles(tags, f, args, errors):
+                playlists[f][title].add(musicCatalog.toBytes(p))
+    catalog.close()
+    for value in sorted(set(errors)):
+        print("Error: Unrecognized character in '{}'".format(value))
+
+    for f in facets:
+        if len(facets) == 1:
+            playlistDir = args.playlistDir
+        else:
+            playlistDir = os.path.join(args.playlistDir, f)
+        writePlaylists(playlistDir, playlists[f])
 
 if __name__ == '__main__':
     main()
@@ -12,19 +12,23 @@ are lower case strings separated by dashes.
 See my blog post
 [Using Python to organize a music directory](http://bamos.github.io/2014/07/05/music-organizer/)
 for a more detailed overview of this script.
+
+The collection is walked once and the tags of new and changed songs are
+read once, in a pool of `--jobs` threads, into a `musicCatalog` in the
+collection. The cataloged tags are then turned into a plan of the moves
+and deletions to make, which `--dry-run` prints instead of carrying out.
+Tags changed by `--numbering` are written at most once per song, when
+the plan is applied. Songs with a tag `toNeat` doesn't recognize are
+reported and left in place instead of stopping the whole run.
 """
 
 import argparse
-import glob
 import os
-import re
-import shutil
 import sys
 import toNeat
-from mutagen.easyid3 import EasyID3
-from mutagen.oggvorbis import OggVorbis
 import tracknumber
 import audioFunction
+import musicCatalog
 
 parser = argparse.ArgumentParser(
         description='''Organizes a music collection using tag information.
@@ -52,110 +56,198 @@ parser.add_argument('-n','--numbering', action='store_true',
 parser.add_argument('-C','--capital', action='store_true',
         dest='capital',
         help='''Makes the first letter of a song capital''')
+parser.add_argument('--dry-run', action='store_true',
+        dest='dry_run',
+        help='''Print the moves and deletions that would be made
+                    without making them''')
+parser.add_argument('-j','--jobs', type=int, default=8,
+        dest='jobs',
+        help='''Number of threads to read tags with''')
+parser.add_argument('--catalog', type=str,
+        dest='catalog',
+        help='''Catalog of the collection's tags. Default:
+                    ./''' + musicCatalog.defaultName)
 args = parser.parse_args()
 
-def artist():
-    print("Organizing artist")
-    delete_dirs = []
+exts = (".mp3", ".ogg")
+
+
+class Plan(object):
+    """The changes organizing the collection makes, worked out before
+    any of them are made."""
+
+    def __init__(self):
+        self.moves = []  # (source, target) pairs.
+        self.conflicts = []  # (source, target) pairs.
+        self.deletes = []
+        self.unreadable = []
+        self.unrecognized = []  # (source, tag value) pairs.
+        self.metadata = {}  # Source -> Metadata, saved if changed.
+        self.sourceDirs = set()  # Directories to remove if left empty.
+
+
+def scan():
+    """Get the paths of the songs and other files in the collection,
+    walking it once.
+
+    Catalogs, including ones other scripts made in subdirectories, and
+    their SQLite journals are skipped."""
+    songs = []
+    others = []
+    catalogPath = os.path.abspath(args.catalog) if args.catalog else None
     for dirname, dirnames, filenames in os.walk("."):
-        # Move all the files to the root directory.
+        if dirname == ".":
+            dirnames[:] = [d for d in dirnames
+                           if d not in ('iTunes', 'playlists')]
         for filename in filenames:
-            fullPath = os.path.join(dirname, filename)
-            # formating song
-            returned = song(fullPath)
-            if returned is "succes":
-                print("succesful formated")
-            elif returned is "delete":
-                print"deleted remaining files in folder"
+            if filename.startswith(musicCatalog.defaultName):
+                continue
+            fullPath = os.path.normpath(os.path.join(dirname, filename))
+            if catalogPath and os.path.abspath(fullPath) in (
+                    catalogPath, catalogPath + "-journal",
+                    catalogPath + "-wal", catalogPath + "-shm"):
+                continue
+            if os.path.splitext(filename)[1] in exts:
+                songs.append(fullPath)
             else:
-                returnedlist = returned.split('/')
-                for extdir in returnedlist:
-                    if extdir in delete_dirs:
-                        delete_dirs.remove(extdir)
-
-        # Add subdirectories to a list 
-        for subdirname in dirnames:
-            delete_dirs.append(subdirname)
-
-    # deletes subdirectories
-    for d in delete_dirs:
-        shutil.rmtree(os.path.join(".", d), ignore_errors=True)
-
-def song(filename):
-#    if filename[0] == '.':
-#       print("Ignoring dotfile: '{}'".format(filename))
-#       return
-    ext = os.path.splitext(filename)[1]
-    if ext in (".mp3" , ".ogg"):
-        print("Organizing song '" + filename + "'.")
-        try:
-            audio = audioFunction.returnAudio(filename)
-            artist = audio['artist'][0].encode('ascii', 'ignore')
-            title = audio['title'][0].encode('ascii', 'ignore')
-            if args.album:
-                album = audio['album'][0].encode('ascii', 'ignore')
-            if args.numbering:
-                neatTracknumber = tracknumber.getTracknumber(filename)
-            print("    artist: " + artist)
-            print("    title: " + title)
-            if args.album:
-                print("    album: " + album)
-        except:
-            artist = None
-            title = None
-            if args.album:
-                album = None
-            if args.numbering:
-                neatTracknumber = None
-        
-        neatArtist = toNeat.toNeat(artist, args)
-        if args.numbering:
-            neatTitle = neatTracknumber + "." + toNeat.toNeat(title, args)
-        else:
-            neatTitle = toNeat.toNeat(title, args)
-        if args.album:
-            neatAlbum = toNeat.toNeat(album, args)
-        print("    neatArtist: " + neatArtist)
-        print("    neatTitle: " + neatTitle)
-        if args.album:
-            print("    neatAlbum: " + neatAlbum)
-        if not os.path.isdir(neatArtist):
-            os.mkdir(neatArtist)
+                others.append(fullPath)
+    return songs, others
+
+
+def readSong(filename, catalogTags):
+    """Get the tags of a song from its cataloged tags, returning None if
+    they couldn't be read.
+
+    The song's `Metadata` is returned with them, and any changes to it,
+    such as the tracknumber formatting, are only saved when applying."""
+    if catalogTags is None:
+        return None
+    try:
+        meta = audioFunction.Metadata(filename, catalogTags)
+        tags = {
+            'metadata': meta,
+            'artist': meta['artist'][0].encode('ascii', 'ignore'),
+            'title': meta['title'][0].encode('ascii', 'ignore')
+        }
         if args.album:
-            if not os.path.isdir(neatArtist + "/" + neatAlbum):
-                os.mkdir(neatArtist + "/" + neatAlbum)
-            newFullPath = os.path.join(neatArtist, neatAlbum, neatTitle + ext)
-        else:
-            newFullPath = os.path.join(neatArtist, neatTitle + ext)
-
-        if newFullPath != filename:
-            if os.path.isfile(newFullPath):
-                if args.delete_conflicts:
-                    os.remove(filename)
-                    print("File exists: '" + newFullPath + "'")
-                    print("Deleted: '" + filename + "'")
-                else:
-                    print("Error: File exists: '" + newFullPath + "'")
-                    return os.path.split(newFullPath)[0]
-            else:
-                os.rename(filename, newFullPath)
-                return "succes"
+            tags['album'] = meta['album'][0].encode('ascii', 'ignore')
+        if args.numbering:
+            tags['tracknumber'] = tracknumber.getTracknumber(meta)
+        return tags
+    except Exception:
+        return None
+
 
-    else:
+def song(filename, tags, errors):
+    """Get the path a song with the given tags belongs at, or None if a
+    tag has an unrecognized character, which is appended to `errors`."""
+    names = ['artist', 'album', 'title'] if args.album else \
+        ['artist', 'title']
+    neatNames = toNeat.toNeatAll([tags[n] for n in names], args, errors)
+    if None in neatNames:
+        return None
+    if args.numbering:
+        neatNames[-1] = tags['tracknumber'] + "." + neatNames[-1]
+    ext = os.path.splitext(filename)[1]
+    neatNames[-1] += ext
+    return os.path.join(*neatNames)
+
+
+def plan(catalog, songs, others):
+    """Update the tags of `songs` in `catalog` and plan where they and
+    `others` go."""
+    p = Plan()
+    if others:
         if not args.delete_unrecognized:
-            print("Error: Unrecognized file extension in '{}'.".format(filename))
+            for filename in others:
+                print("Error: Unrecognized file extension in '{}'.".format(
+                    filename))
             sys.exit(-42)
+        p.deletes.extend(others)
+        p.sourceDirs.update(os.path.dirname(f) for f in others)
+
+    catalog.update(songs, args.jobs)
+    catalogTags = dict(catalog.songs())
+    targets = set()
+    for filename in songs:
+        tags = readSong(filename, catalogTags.get(catalog.key(filename)))
+        if tags is None:
+            p.unreadable.append(filename)
+            continue
+        errors = []
+        newFullPath = song(filename, tags, errors)
+        if newFullPath is None:
+            p.unrecognized.extend((filename, e) for e in errors)
+            continue
+        p.metadata[filename] = tags['metadata']
+        if newFullPath == filename:
+            targets.add(newFullPath)
+        elif newFullPath in targets or os.path.isfile(newFullPath):
+            p.conflicts.append((filename, newFullPath))
+            if args.delete_conflicts:
+                p.deletes.append(filename)
         else:
-            return "delete"
- 
+            targets.add(newFullPath)
+            p.moves.append((filename, newFullPath))
+        p.sourceDirs.add(os.path.dirname(filename))
+    return p
+
+
+def show(p):
+    for filename in p.unreadable:
+        print("Error: Couldn't read the tags of '{}'.".format(filename))
+    for filename, value in p.unrecognized:
+        print("Error: Unrecognized character in '{}' of '{}'.".format(
+            value, filename))
+    for filename, newFullPath in p.conflicts:
+        print("File exists: '{}' for '{}'".format(newFullPath, filename))
+    for filename, newFullPath in p.moves:
+        print("Move: '{}' -> '{}'".format(filename, newFullPath))
+    for filename in p.deletes:
+        print("Delete: '{}'".format(filename))
+
+
+def apply(catalog, p):
+    """Make the changes in a plan, keeping `catalog` up to date, and
+    remove the source directories left empty."""
+    for filename, newFullPath in p.moves:
+        meta = p.metadata.pop(filename)
+        meta.save()
+        newDir = os.path.dirname(newFullPath)
+        if not os.path.isdir(newDir):
+            os.makedirs(newDir)
+        os.rename(filename, newFullPath)
+        catalog.remove(filename)
+        catalog.put(newFullPath, meta.asDict())
+        print("Moved: '{}' -> '{}'".format(filename, newFullPath))
+    for filename in p.deletes:
+        p.metadata.pop(filename, None)
+        os.remove(filename)
+        catalog.remove(filename)
+        print("Deleted: '{}'".format(filename))
+    # Songs that stay where they are.
+    for filename, meta in p.metadata.items():
+        if meta.save():
+            catalog.put(filename, meta.asDict())
+    catalog.commit()
+
+    # Deepest first, so parents emptied by removing children go too.
+    for d in sorted(p.sourceDirs, key=len, reverse=True):
+        while d and os.path.isdir(d) and not os.listdir(d):
+            os.rmdir(d)
+            d = os.path.dirname(d)
+
 
 def collection():
-    for f in glob.glob('*'):
-        if os.path.isdir(f):
-            if f != 'iTunes' and f != 'playlists':
-                artist()
-        elif os.path.isfile(f):
-            song(f)
+    catalog = musicCatalog.Catalog(".", args.catalog)
+    p = plan(catalog, *scan())
+    show(p)
+    if not args.dry_run:
+        apply(catalog, p)
+    catalog.close()
+    if p.conflicts and not args.delete_conflicts:
+        print("\n{} conflicts left in place.".format(len(p.conflicts)))
+
 
 collection()
 print("\nComplete!")
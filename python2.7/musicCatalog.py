@@ -0,0 +1,177 @@
+#!/usr/bin/env python2.7
+
+"""
+A SQLite catalog of the tags of the songs in a music library.
+
+Each song's tags are stored with its size and mtime, and `update` only
+parses the songs that are new or changed since the last scan, so the
+music scripts can query an unchanged library without parsing anything.
+
+Songs are keyed on their absolute paths decoded to unicode, which
+SQLite needs for non-ASCII names. The methods take paths as bytes or
+unicode, and `toBytes` turns a cataloged path back into the file
+system's bytes.
+"""
+
+import audioFunction
+import codecs
+import json
+import os
+import sqlite3
+import sys
+from multiprocessing.pool import ThreadPool
+
+defaultName = ".music-catalog.sqlite"
+exts = (".mp3", ".ogg")
+
+# The encoding of file names. The C locale's ASCII would leave every
+# non-ASCII name undecodable, so UTF-8 is assumed there instead.
+fsEncoding = sys.getfilesystemencoding() or 'utf-8'
+if codecs.lookup(fsEncoding).name == 'ascii':
+    fsEncoding = 'utf-8'
+
+
+def toUnicode(path):
+    """Get `path` as unicode, or None if it can't be decoded."""
+    if isinstance(path, bytes):
+        try:
+            return path.decode(fsEncoding)
+        except UnicodeDecodeError:
+            return None
+    return path
+
+
+def toBytes(path):
+    """Get `path` as the bytes the file system uses."""
+    if isinstance(path, bytes):
+        return path
+    return path.encode(fsEncoding)
+
+
+def readTags(path):
+    """Read all the tags of a song as a dict of lists, or None if they
+    can't be read."""
+    try:
+        audio = audioFunction.returnAudio(path)
+        return dict((k, list(v)) for k, v in audio.items())
+    except Exception:
+        return None
+
+
+class Catalog(object):
+    """The tags of the songs under `root`, keyed on their absolute paths.
+
+    Songs whose tags couldn't be read are kept with None tags, so they
+    aren't read again until they change."""
+
+    def __init__(self, root=".", dbPath=None):
+        self.root = os.path.abspath(toBytes(root))
+        self.db = sqlite3.connect(dbPath or os.path.join(root, defaultName))
+        self.db.execute("CREATE TABLE IF NOT EXISTS songs (path TEXT PRIMARY "
+                        "KEY, size INTEGER, mtime REAL, tags TEXT)")
+        # Older catalogs also have a table of each tag value of each
+        # song, which nothing reads.
+        self.db.execute("DROP TABLE IF EXISTS tags")
+
+    def find(self):
+        """Get the paths of the songs under `root`, as bytes."""
+        paths = []
+        for dirname, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if d != '.git']
+            for filename in filenames:
+                if os.path.splitext(filename)[1] in exts:
+                    paths.append(os.path.join(dirname, filename))
+        return paths
+
+    def update(self, paths=None, jobs=8):
+        """Bring the catalog up to date with the songs at `paths`, or
+        all the songs under `root`, reading the tags of new and changed
+        songs in `jobs` threads.
+
+        Cataloged songs that weren't found are forgotten without checking
+        each one: those under `root`, or with `paths`, those in the same
+        directories as `paths`. Songs whose paths can't be decoded aren't
+        cataloged.
+
+        Returns the number of songs read and removed."""
+        known = dict((row[0], row[1:]) for row in self.db.execute(
+            "SELECT path, size, mtime FROM songs"))
+        todo = []
+        seen = set()
+        for path in (self.find() if paths is None else paths):
+            path = os.path.abspath(toBytes(path))
+            key = toUnicode(path)
+            if key is None:
+                continue
+            st = os.stat(path)
+            seen.add(key)
+            if known.get(key) != (st.st_size, st.st_mtime):
+                todo.append((key, path, st.st_size, st.st_mtime))
+
+        pool = ThreadPool(jobs)
+        for (key, path, size, mtime), tags in zip(
+                todo, pool.imap(readTags, [t[1] for t in todo])):
+            self.store(key, size, mtime, tags)
+        pool.close()
+        pool.join()
+
+        if paths is None:
+            root = toUnicode(os.path.join(self.root, ""))
+            gone = [key for key in known
+                    if key not in seen and key.startswith(root)]
+        else:
+            dirs = set(os.path.dirname(key) for key in seen)
+            gone = [key for key in known
+                    if key not in seen and os.path.dirname(key) in dirs]
+        for key in gone:
+            self.delete(key)
+        self.db.commit()
+        return len(todo), len(gone)
+
+    def store(self, key, size, mtime, tags):
+        """Record the tags of the song cataloged under `key`."""
+        self.delete(key)
+        self.db.execute("INSERT INTO songs VALUES (?, ?, ?, ?)",
+                        (key, size, mtime,
+                         None if tags is None else json.dumps(tags)))
+
+    def put(self, path, tags):
+        """Record the current tags of the song at `path`, such as after
+        moving it or saving its tags."""
+        path = os.path.abspath(toBytes(path))
+        key = toUnicode(path)
+        if key is not None:
+            st = os.stat(path)
+            self.store(key, st.st_size, st.st_mtime, tags)
+
+    def key(self, path):
+        """Get the unicode path the song at `path` is cataloged under, or
+        None if it can't be decoded."""
+        return toUnicode(os.path.abspath(toBytes(path)))
+
+    def remove(self, path):
+        self.delete(self.key(path))
+
+    def delete(self, key):
+        self.db.execute("DELETE FROM songs WHERE path = ?", (key,))
+
+    def commit(self):
+        self.db.commit()
+
+    def tags(self, path):
+        """Get the cataloged tags of the song at `path`, or None."""
+        row = self.db.execute("SELECT tags FROM songs WHERE path = ?",
+                              (self.key(path),)).fetchone()
+        return json.loads(row[0]) if row and row[0] else None
+
+    def songs(self):
+        """Yield the `(path, tags)` of every readable song, with `path`
+        as unicode."""
+        for path, tags in self.db.execute(
+                "SELECT path, tags FROM songs WHERE tags IS NOT NULL "
+                "ORDER BY path"):
+            yield path, json.loads(tags)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -1,33 +1,162 @@
 #!/usr/bin/env python2.7
 
+"""
+Maps strings such as 'The Beatles' to neat names such as 'the-beatles'.
+
+The translation tables and patterns are built once, and neat names are
+memoized, since the artist and album of every song of a collection
+repeat for each of its tracks. `toNeatAll` neatens a batch of strings,
+and passing an `errors` list collects the strings with unrecognized
+characters instead of exiting.
+Compare it with the original regex-per-call version on a tag dump with:
+
+```
+$ toNeat.py --catalog ~/music/.music-catalog.sqlite
+```
+"""
+
+import argparse
 import re
+import string
 import sys
+import timeit
+
+# Replaced by spaces, which later become dashes.
+blankCharsPad = "()[],.\\?#/!$:;"
+# Removed outright.
+blankCharsNoPad = "'\""
+dashChars = blankCharsPad + " *_"
+
+strTable = string.maketrans(dashChars, "-" * len(dashChars))
+unicodeTable = dict((ord(c), u"-") for c in dashChars)
+unicodeTable.update((ord(c), None) for c in blankCharsNoPad)
+
+unrecognized = {True: re.compile(r"[^0-9a-zA-Z\-\+\=]"),
+                False: re.compile(r"[^0-9a-z\-\+\=]")}
+
+# Neat names keyed on (string, capital), cleared when full like the
+# re module's pattern cache.
+cacheSize = 10000
+cache = {}
+
 
-# Maps a string such as 'The Beatles' to 'the-beatles'.
-def toNeat(s, args):
-    if args.capital:
+def neaten(s, capital):
+    """Get the neat name of `s`, and whether it's only alphanumeric with
+    '-', '+', and '='."""
+    if capital:
         s = s.title().replace("&", "and")
     else:
         s = s.lower().replace("&", "and")
 
-    # Put spaces between and remove blank characters.
-    blankCharsPad = r"()\[\],.\\\?\#/\!\$\:\;"
-    blankCharsNoPad = r"'\""
-    s = re.sub(r"([" + blankCharsPad + r"])([^ ])", "\\1 \\2", s)
-    s = re.sub("[" + blankCharsPad + blankCharsNoPad + "]", "", s)
+    # A padded blank character always ends up as a single dash between
+    # words, so it's translated straight to one, and runs of dashes are
+    # joined into one.
+    if isinstance(s, bytes):
+        s = s.translate(strTable, blankCharsNoPad)
+    else:
+        s = s.translate(unicodeTable)
+    s = "-".join(w for w in s.split("-") if w)
+    return s, not unrecognized[bool(capital)].search(s)
+
+
+def toNeat(s, args, errors=None):
+    """Get the neat name of `s`.
+
+    If it has an unrecognized character, `s` is appended to `errors` and
+    None is returned, or the script exits if `errors` isn't given."""
+    key = (s, args.capital)
+    result = cache.get(key)
+    if result is None:
+        if len(cache) >= cacheSize:
+            cache.clear()
+        result = cache[key] = neaten(s, args.capital)
+    neat, ok = result
+    if ok:
+        return neat
+    if errors is None:
+        print("Error: Unrecognized character in '" + neat + "'")
+        sys.exit(-42)
+    errors.append(s)
+    return None
+
+
+def toNeatAll(strings, args, errors=None):
+    """Get the neat names of `strings`, with None for those collected in
+    `errors`."""
+    return [toNeat(s, args, errors) for s in strings]
 
-    # Replace spaces with a single dash.
+
+def originalNeat(s, capital):
+    """The original version of `neaten`, which builds and runs its
+    patterns on every call, kept to check and benchmark against."""
+    if capital:
+        s = s.title().replace("&", "and")
+    else:
+        s = s.lower().replace("&", "and")
+    pad = r"()\[\],.\\\?\#/\!\$\:\;"
+    noPad = r"'\""
+    s = re.sub(r"([" + pad + r"])([^ ])", "\\1 \\2", s)
+    s = re.sub("[" + pad + noPad + "]", "", s)
     s = re.sub(r"[ \*\_]+", "-", s)
     s = re.sub("-+", "-", s)
     s = re.sub("^-*", "", s)
     s = re.sub("-*$", "", s)
+    if capital:
+        search = re.search(r"[^0-9a-zA-Z\-\+\=]", s)
+    else:
+        search = re.search(r"[^0-9a-z\-\+\=]", s)
+    return s, not search
+
+
+def catalogStrings(path):
+    """Get the artist, title and album of every song in a catalog, as
+    music-organizer.py neatens them."""
+    import musicCatalog
+    catalog = musicCatalog.Catalog(".", path)
+    strings = [v.encode('ascii', 'ignore')
+               for _, tags in catalog.songs()
+               for tag in ('artist', 'title', 'album')
+               for v in tags.get(tag, [])[:1]]
+    catalog.close()
+    return strings
 
-    # Ensure the string is only alphanumeric with '-', '+', and '='.
-    if args.capital:
-        search = re.search("[^0-9a-zA-Z\-\+\=]", s)
+
+def benchmark(strings, capital, number=3):
+    """Check `neaten` against the original version on `strings`, then
+    print the per-string cost of each way of neatening them."""
+    for s in set(strings):
+        assert neaten(s, capital) == originalNeat(s, capital), s
+    args = argparse.Namespace(capital=capital)
+
+    def cold():
+        cache.clear()
+        toNeatAll(strings, args, [])
+
+    runs = [("original", lambda: [originalNeat(s, capital) for s in strings]),
+            ("precompiled", lambda: [neaten(s, capital) for s in strings]),
+            ("memoized", cold),
+            ("warm cache", lambda: toNeatAll(strings, args, []))]
+    print("{} strings, {} distinct.".format(len(strings), len(set(strings))))
+    for label, f in runs:
+        t = min(timeit.repeat(f, number=number, repeat=3))
+        print("{:>12}: {:.3f} us/string".format(
+            label, 1e6 * t / number / len(strings)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark toNeat on a dump of tags.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--catalog', type=str,
+                       help="A music catalog to read the artists, titles "
+                            "and albums of.")
+    group.add_argument('--dump', type=argparse.FileType('r'),
+                       help="A file with one tag value per line.")
+    parser.add_argument('-C', '--capital', action='store_true')
+    args = parser.parse_args()
+
+    if args.catalog:
+        strings = catalogStrings(args.catalog)
     else:
-        search = re.search("[^0-9a-z\-\+\=]", s)
-    if search:
-        print("Error: Unrecognized character in '" + s + "'")
-        sys.exit(-42)
-    return s
+        strings = [line.rstrip("\n") for line in args.dump]
+    benchmark(strings, args.capital)
@@ -1,31 +1,42 @@
 #!/usr/bin/env python2.7
 
-from mutagen.easyid3 import EasyID3
-from mutagen.oggvorbis import OggVorbis
 import audioFunction
 import os
 import re
 
-def fixTracknumber(fname):
+def metadata(song):
+    """Get the `audioFunction.Metadata` of a song given as either that or
+    a path."""
+    if isinstance(song, audioFunction.Metadata):
+        return song
+    return audioFunction.Metadata(song)
+
+def fixTracknumber(song):
     print("fixTracknumber")
-    audio = audioFunction.returnAudio(fname)
+    meta = metadata(song)
     try:
-        tracknumber = re.findall(r'\d+', os.path.basename(fname).split(' ')[0])[0]
-    except:
+        tracknumber = re.findall(r'\d+', os.path.basename(meta.path).split(' ')[0])[0]
+    except IndexError:
         tracknumber = "0"
-    audio['tracknumber'] = tracknumber.zfill(2)
-    return formatNumber(audio)
+    meta['tracknumber'] = tracknumber.zfill(2)
+    return meta
+
+def formatNumber(song):
+    """Make the tracknumber of a song a bare number, filling it in from
+    the file name if it's missing.
 
-def formatNumber(fname):
-    audio = audioFunction.returnAudio(fname)
-    if 'tracknumber' not in audio:
-        fixTracknumber(fname)
-    if '/' in audio['tracknumber'][0]:
-        audio['tracknumber'] = audio['tracknumber'][0].split('/')[0]
-    audio['tracknumber'][0]
-    audio.save()
-    return audio
+    Given a path, the song is saved if it changed. Given a `Metadata`,
+    saving it is left to the caller, so all its changes are written at
+    once."""
+    meta = metadata(song)
+    if 'tracknumber' not in meta:
+        fixTracknumber(meta)
+    if '/' in meta['tracknumber'][0]:
+        meta['tracknumber'] = meta['tracknumber'][0].split('/')[0]
+    if meta is not song:
+        meta.save()
+    return meta
 
-def getTracknumber(fname):
-    audio = formatNumber(fname)
-    return audio['tracknumber'][0].encode('ascii', 'ignore')
+def getTracknumber(song):
+    meta = formatNumber(song)
+    return meta['tracknumber'][0].encode('ascii', 'ignore')
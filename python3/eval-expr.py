@@ -17,25 +17,285 @@ If you want a command-line expression evaluator, use
 $ eval-expr.py '(((4+6)*10)<<2)'
 (((4+6)*10)<<2) = 400
 ```
+
+Expressions are compiled once into a Python function of the variable map
+and cached, so evaluating the same expression with different bindings
+doesn't re-parse or re-walk the AST.
+Compare the compiled and tree-walking evaluators with:
+
+```
+$ eval-expr.py --benchmark 'x*(x+1)<<2'
+```
+
+`EvalExpr.evalBatch` evaluates an expression over columns of values,
+using NumPy ufuncs when NumPy is installed and falling back to
+evaluating each row in Python otherwise. `--check` checks both against
+`evalExpr` row by row.
+
+Constant subexpressions are folded and repeated subexpressions are
+computed once. `Pow`, `LShift` and `Mult` refuse integer operands longer
+than `maxBits` bits or results predicted to be longer than
+`maxResultBits` bits, and expressions with more than `maxNodes` nodes
+aren't compiled, so `9**9**9` fails fast with a `LimitError` instead
+of hanging.
+
+Many expressions can be streamed through one process with `--file`,
+one per line, optionally followed by `;` and `name=value` bindings.
+`--jobs` spreads the lines over a process pool.
+
+```
+$ printf 'x*y; x=3 y=4\n2**10\n' | eval-expr.py --file -
+x*y = 12
+2**10 = 1024
+```
 """
 
+import argparse
+import array
 import ast
+import functools
+import itertools
+import math
+import multiprocessing
 import operator as op
+import re
+import sys
+import time
+import timeit
+
+np = None
+npOps = None
+
+
+def importNumpy():
+    """Import NumPy on first use so the command-line modes don't pay
+    for it at startup. Returns False if NumPy isn't installed."""
+    global np, npOps
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+        np = numpy
+        npOps = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+                 ast.Div: np.true_divide, ast.Mod: np.mod, ast.Pow: np.power,
+                 ast.LShift: np.left_shift, ast.RShift: np.right_shift,
+                 ast.BitOr: np.bitwise_or, ast.BitXor: np.bitwise_xor,
+                 ast.BitAnd: np.bitwise_and, ast.FloorDiv: np.floor_divide,
+                 ast.Invert: np.invert, ast.Not: np.logical_not,
+                 ast.UAdd: np.positive, ast.USub: np.negative}
+    return True
+
+
+class LimitError(ValueError):
+    """Raised when evaluating an expression would exceed a limit."""
+    pass
 
 
 class EvalExpr:
-    def __init__(self, varMap):
+    def __init__(self, varMap, cacheSize=1024, maxBits=1 << 16,
+                 maxResultBits=1 << 16, maxNodes=1000):
         self.ops = {ast.Add: op.add, ast.Sub: op.sub, ast.Mult: op.mul,
                     ast.Div: op.truediv, ast.Mod: op.mod, ast.Pow: op.pow,
                     ast.LShift: op.lshift, ast.RShift: op.rshift,
                     ast.BitOr: op.or_, ast.BitXor: op.xor, ast.BitAnd: op.and_,
                     ast.FloorDiv: op.floordiv, ast.Invert: op.invert,
                     ast.Not: op.not_, ast.UAdd: op.pos, ast.USub: op.neg}
+        self.maxBits = maxBits
+        self.maxResultBits = maxResultBits
+        self.maxNodes = maxNodes
+        # Below this many bits no limit can be hit, so the guards skip
+        # the detailed checks.
+        self.__fastBits = min(b for b in (maxBits, maxResultBits, float('inf'))
+                              if b is not None)
+        self.__guarded = {}
+        if maxBits is not None or maxResultBits is not None:
+            self.__guarded = {ast.Pow: self.__pow, ast.LShift: self.__lshift,
+                              ast.Mult: self.__mul}
+            self.ops.update(self.__guarded)
         self.varMap = varMap
+        self.compileExpr = functools.lru_cache(maxsize=cacheSize)(
+            self.__compile)
 
     def evalExpr(self, expr):
+        f = self.compileExpr(expr)
+        try:
+            return f(self.varMap)
+        except KeyError as e:
+            raise TypeError("Unbound variable: {}".format(e))
+
+    def evalBatch(self, expr, columns, useNumpy=True):
+        """Evaluate `expr` once per row of `columns`.
+
+        `columns` maps variable names to equal-length sequences (lists,
+        NumPy arrays or buffers such as `array.array`); variables missing
+        from `columns` are taken from `self.varMap`.
+        With NumPy, returns an array computed with the ufuncs matching
+        `self.ops`. Results match `evalExpr` row by row except where
+        NumPy's semantics differ: fixed-width integers wrap around,
+        division by zero gives inf/nan, and integers can't be raised to
+        negative integer powers. Object arrays, such as columns of
+        ints too large for int64, are raised, shifted and multiplied
+        element by element, under the same limits as `evalExpr`.
+        Without NumPy, or if not `useNumpy`, returns a list.
+        """
+        names = list(columns)
+        if useNumpy and importNumpy():
+            f = self.compileExpr(expr, vectorized=True)
+            varMap = dict(self.varMap)
+            varMap.update((k, np.asarray(v)) for k, v in columns.items())
+            try:
+                r = f(varMap)
+            except KeyError as e:
+                raise TypeError("Unbound variable: {}".format(e))
+            if np.ndim(r) == 0:
+                r = np.full(len(columns[names[0]]) if names else 1, r)
+            return r
+        else:
+            f = self.compileExpr(expr)
+            varMap = dict(self.varMap)
+            result = []
+            for row in zip(*[columns[k] for k in names]) if names else [()]:
+                varMap.update(zip(names, row))
+                try:
+                    result.append(f(varMap))
+                except KeyError as e:
+                    raise TypeError("Unbound variable: {}".format(e))
+            return result
+
+    def walkExpr(self, expr):
+        """Evaluate `expr` by walking its AST on every call."""
         return self.__eval(ast.parse(expr).body[0].value)
 
+    def __compile(self, expr, vectorized=False):
+        """Compile `expr` into a function taking the variable map.
+
+        Only the nodes accepted by `__eval` are translated, and every
+        operator is called through `self.ops` (or the NumPy ufunc for
+        the same operator if `vectorized`), so the generated code
+        can't do anything the tree walker couldn't.
+        The function assigns each distinct subexpression to a local
+        once, and constant subexpressions are evaluated here instead.
+        """
+        if vectorized:
+            ops = {k: npOps[k] for k in self.ops}
+            ops.update((k, self.__guardObjects(ops[k], f))
+                       for k, f in self.__guarded.items())
+        else:
+            ops = self.ops
+        tree = ast.parse(expr, mode='eval').body
+        if self.maxNodes is not None:
+            n = sum(1 for node in ast.walk(tree) if isinstance(node, ast.expr))
+            if n > self.maxNodes:
+                raise LimitError("Expression has {} nodes, more than the "
+                                 "limit of {}.".format(n, self.maxNodes))
+        env = {'__builtins__': {}}
+        lines = []
+        seen = {}
+        name = self.__ref(self.__emit(tree, ops, env, lines, seen), env, seen)
+        src = "def f(v):\n{}    return {}\n".format(
+            "".join("    {} = {}\n".format(*line) for line in lines), name)
+        exec(compile(src, "<expr>", "exec"), env)
+        return env['f']
+
+    def __guardObjects(self, ufunc, guarded):
+        """Wrap `ufunc` so object arrays, such as Python ints too large
+        for int64, go through `guarded` element by element and are held
+        to the same limits as in `evalExpr`."""
+        elementwise = np.frompyfunc(guarded, 2, 1)
+
+        def f(a, b):
+            if np.asarray(a).dtype == object or np.asarray(b).dtype == object:
+                return elementwise(a, b)
+            return ufunc(a, b)
+        return f
+
+    def __emit(self, node, ops, env, lines, seen):
+        """Emit the assignments computing `node` into `lines`.
+
+        Returns `(name, None)` for the local holding the value, or
+        `(None, value)` if `node` folds to a constant.
+        """
+        if isinstance(node, ast.Constant) and \
+                type(node.value) in (int, float, complex):
+            return None, node.value
+        elif isinstance(node, ast.Name):
+            return self.__assign("v[{!r}]".format(node.id), lines, seen), None
+        elif isinstance(node, (ast.UnaryOp, ast.BinOp)) and \
+                type(node.op) in ops:
+            f = ops[type(node.op)]
+            if isinstance(node, ast.UnaryOp):
+                args = [self.__emit(node.operand, ops, env, lines, seen)]
+            else:
+                args = [self.__emit(node.left, ops, env, lines, seen),
+                        self.__emit(node.right, ops, env, lines, seen)]
+            if all(name is None for name, _ in args):
+                try:
+                    return None, f(*[value for _, value in args])
+                except LimitError:
+                    raise
+                except Exception:
+                    pass  # Leave it for evaluation to raise.
+            fName = "_" + type(node.op).__name__
+            env[fName] = f
+            return self.__assign("{}({})".format(fName, ", ".join(
+                self.__ref(arg, env, seen) for arg in args)), lines, seen), None
+        else:
+            raise TypeError(node)
+
+    def __assign(self, rhs, lines, seen):
+        if rhs not in seen:
+            seen[rhs] = "_t{}".format(len(seen))
+            lines.append((seen[rhs], rhs))
+        return seen[rhs]
+
+    def __ref(self, arg, env, seen):
+        """Return the name holding an `__emit` result, binding constants
+        in `env`."""
+        name, value = arg
+        if name is None:
+            # Ints are keyed on their value, since repr refuses ints
+            # longer than sys.get_int_max_str_digits(). Other constants
+            # are keyed on their repr, which keeps 0.0 and -0.0 apart.
+            if type(value) is int:
+                key = (int, value)
+            else:
+                key = (type(value), repr(value))
+            if key not in seen:
+                seen[key] = "_c{}".format(len(seen))
+                env[seen[key]] = value
+            name = seen[key]
+        return name
+
+    def __check(self, a, b, resultBits):
+        for x in (a, b):
+            if self.maxBits is not None and x.bit_length() > self.maxBits:
+                raise LimitError("Operand has {} bits, more than the limit "
+                                 "of {}.".format(x.bit_length(), self.maxBits))
+        if self.maxResultBits is not None and resultBits > self.maxResultBits:
+            raise LimitError("Result would have about {} bits, more than the "
+                             "limit of {}.".format(resultBits,
+                                                   self.maxResultBits))
+
+    def __pow(self, a, b):
+        if isinstance(a, int) and isinstance(b, int) and \
+                not 0 <= max(a.bit_length(), 1) * b <= self.__fastBits:
+            self.__check(a, b, (a.bit_length() - 1) * b + 1
+                         if b > 0 and abs(a) > 1 else 0)
+        return a ** b
+
+    def __lshift(self, a, b):
+        if isinstance(a, int) and isinstance(b, int) and \
+                not 0 <= a.bit_length() + b <= self.__fastBits:
+            self.__check(a, b, a.bit_length() + b if a and b > 0 else 0)
+        return a << b
+
+    def __mul(self, a, b):
+        if isinstance(a, int) and isinstance(b, int) and \
+                a.bit_length() + b.bit_length() > self.__fastBits:
+            self.__check(a, b, a.bit_length() + b.bit_length() - 1)
+        return a * b
+
     def __eval(self, node):
         if isinstance(node, ast.Num):
             return node.n
@@ -51,10 +311,173 @@ class EvalExpr:
         else:
             raise TypeError(node)
 
+
+def benchmark(expr, number=100000):
+    """Print the per-evaluation cost of the tree walker and the
+    compiled evaluator on `expr`, binding every variable to 3."""
+    names = {n.id for n in ast.walk(ast.parse(expr)) if isinstance(n, ast.Name)}
+    e = EvalExpr({name: 3 for name in names})
+    assert e.walkExpr(expr) == e.evalExpr(expr)
+    for label, f in [("tree walk", e.walkExpr), ("compiled", e.evalExpr)]:
+        t = min(timeit.repeat(lambda: f(expr), number=number, repeat=3))
+        print("{:>10}: {:.3f} us/eval".format(label, 1e6 * t / number))
+    columns = {name: list(range(number)) for name in names}
+    if importNumpy():
+        columns = {name: np.asarray(v) for name, v in columns.items()}
+    t = min(timeit.repeat(lambda: e.evalBatch(expr, columns),
+                          number=1, repeat=3))
+    print("{:>10}: {:.3f} us/eval".format("batch", 1e6 * t / number))
+
+
+# Expressions `checkBatch` evaluates, chosen so NumPy's semantics don't
+# differ on its columns. The bitwise ones are only checked on ints.
+checkExprs = ['x*(x+1)<<2', 'x-y*3', '-x+y**2', 'x/(y+1)', 'x%7+y//3',
+              '(x+y)*(x+y)-x', '2**10+x', '~x&y|x^3', 'x>>2']
+bitwiseOps = re.compile(r'[~&|^]|<<|>>')
+
+
+def checkBatch(rows=100):
+    """Check `evalBatch` against `evalExpr` row by row on `checkExprs`,
+    over int and float columns given as lists and as `array.array`s,
+    with NumPy if it's installed and without it.
+
+    Returns the number of values checked and the mismatches, as `(expr,
+    columns, mode, row, batch value, evalExpr value)` tuples."""
+    x = list(range(-(rows // 2), rows - rows // 2))
+    y = list(range(rows))
+    columnSets = [
+        ("int lists", {'x': x, 'y': y}),
+        ("float lists", {'x': [float(v) for v in x],
+                         'y': [float(v) for v in y]}),
+        ("array('l')", {'x': array.array('l', x), 'y': array.array('l', y)}),
+        ("array('d')", {'x': array.array('d', x), 'y': array.array('d', y)})]
+    modes = [("Python", False)]
+    if importNumpy():
+        modes.append(("NumPy", True))
+
+    e = EvalExpr({})
+    checked = 0
+    mismatches = []
+    for expr in checkExprs:
+        for label, columns in columnSets:
+            if isinstance(columns['x'][0], float) and bitwiseOps.search(expr):
+                continue
+            scalar = []
+            for i in range(rows):
+                e.varMap = {k: v[i] for k, v in columns.items()}
+                scalar.append(e.evalExpr(expr))
+            e.varMap = {}
+            for mode, useNumpy in modes:
+                batch = e.evalBatch(expr, columns, useNumpy)
+                for i, (b, s) in enumerate(zip(batch, scalar)):
+                    checked += 1
+                    close = isinstance(s, float) and \
+                        math.isclose(b, s, rel_tol=1e-12)
+                    if b != s and not close:
+                        mismatches.append((expr, label, mode, i, b, s))
+    return checked, mismatches
+
+
+evaluator = EvalExpr({})
+# Binding values are evaluated without any variables, so they can't see
+# the previous line's bindings.
+valueEvaluator = EvalExpr({})
+
+
+def parseNumber(s):
+    """Parse a binding value, skipping the expression cache for the
+    common case of a plain number."""
+    for t in (int, float):
+        try:
+            return t(s)
+        except ValueError:
+            pass
+    return valueEvaluator.evalExpr(s)
+
+
+def evalLine(line):
+    """Evaluate a line of the form `expr[; name=value ...]` and return
+    the formatted result, or the error if the line can't be evaluated."""
+    expr, _, bindings = line.partition(';')
+    expr = expr.strip()
+    try:
+        varMap = {}
+        for binding in re.split(r'[\s,]+', bindings.strip()):
+            if binding:
+                name, eq, value = binding.partition('=')
+                if not eq:
+                    raise ValueError("Bad binding: '{}'".format(binding))
+                varMap[name] = parseNumber(value)
+        evaluator.varMap = varMap
+        return "{} = {}".format(expr, evaluator.evalExpr(expr))
+    except Exception as e:
+        return "{} = Error: {!r}".format(expr, e)
+
+
+def evalStream(f, out, jobs=1, chunkSize=1024):
+    """Evaluate every non-empty line of `f` and write the results to
+    `out` in order. Returns the number of lines evaluated."""
+    lines = (line for line in f if line.strip())
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap(evalLine, lines, chunksize=chunkSize)
+    else:
+        pool = None
+        results = map(evalLine, lines)
+    n = 0
+    for chunk in iter(lambda: list(itertools.islice(results, chunkSize)), []):
+        out.write("\n".join(chunk) + "\n")
+        n += len(chunk)
+    if pool:
+        pool.close()
+        pool.join()
+    return n
+
+
 if __name__ == "__main__":
-    import sys
-    if len(sys.argv) == 2:
-        expr = sys.argv[1]
-        print(expr + " = " + str(EvalExpr({}).evalExpr(expr)))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('expr', type=str, nargs='?',
+                        help="Expression to evaluate.")
+    parser.add_argument('-f', '--file', type=argparse.FileType('r'),
+                        help="Evaluate each line of a file ('-' for stdin).")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Worker processes to use with --file.")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help="Print throughput to stderr.")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="Compare the evaluators on expr.")
+    parser.add_argument('--check', action='store_true',
+                        help="Check evalBatch against evalExpr row by row "
+                        "and exit.")
+    # An expression starting with '-' and not a letter, such as '-5+3',
+    # can't be an option, so it's passed after '--' for argparse.
+    argv = sys.argv[1:]
+    exprs = [i for i, arg in enumerate(argv) if re.match(r'-[^-a-zA-Z]', arg)]
+    if len(exprs) == 1:
+        argv = argv[:exprs[0]] + argv[exprs[0] + 1:] + ['--', argv[exprs[0]]]
+    args = parser.parse_args(argv)
+
+    if args.check:
+        checked, mismatches = checkBatch()
+        for expr, label, mode, i, b, s in mismatches:
+            print("{} on {} with {}, row {}: batch gives {!r}, evalExpr "
+                  "gives {!r}.".format(expr, label, mode, i, b, s))
+        print("Checked {} values, {} differ.".format(checked,
+                                                     len(mismatches)))
+        sys.exit(1 if mismatches else 0)
+    elif args.file:
+        out = open(sys.stdout.fileno(), 'w', buffering=1 << 16, closefd=False)
+        start = time.time()
+        n = evalStream(args.file, out, args.jobs)
+        out.flush()
+        if args.verbose:
+            elapsed = time.time() - start
+            sys.stderr.write("Evaluated {} lines in {:.2f} seconds. "
+                             "{:.0f} lines/second.\n".format(
+                                 n, elapsed, n / max(elapsed, 1e-9)))
+    elif args.expr is None:
+        parser.print_usage()
+    elif args.benchmark:
+        benchmark(args.expr)
     else:
-        print("Usage: ./EvalExpr.py <mathematical expression>")
+        print(args.expr + " = " + str(evaluator.evalExpr(args.expr)))
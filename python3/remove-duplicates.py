@@ -7,12 +7,45 @@ __date__ = '2015.06.06'
 Detect and remove duplicate images using average hashing.
 
 http://www.hackerfactor.com/blog/index.php?/archives/432-Looks-Like-It.html
+
+`--hash` picks difference or perceptual hashing instead. JPEGs are
+decoded at a reduced scale, straight to grayscale, and the small
+thumbnails are hashed in batches with NumPy. `--check-hashes` checks
+these hashes against imagehash's on the same thumbnails, and reports
+how far they drift from imagehash's on the full images.
+
+Images are hashed by a pool of `--jobs` processes, fed from every class
+in turn so the pool stays busy, and the throughput is printed to stderr.
+Hashes are cached in a SQLite database (by default
+`.remove-duplicates-cache.sqlite` in the image directory) keyed on each
+image's path, size, mtime and inode, so only new or changed images are
+decoded on later runs.
+
+With `--max-distance N`, images whose hashes differ in at most `N` bits
+are grouped as duplicates too, which catches re-encoded and resized
+copies. Candidate pairs are found with a multi-index hash table instead
+of comparing every pair.
+
+Duplicates are searched for within each class (subdirectory) unless
+`--global` is given, in which case a single index over the whole tree is
+built and duplicate groups spanning several classes are reported. The
+index holds each hash as a hex string and each path once, about 300MB
+per million images. With `--delete`, `--keep` chooses the image to keep:
+the largest (default), the oldest, or the one in the earliest `--prefer`
+class.
 """
 
 import argparse
+import functools
 import hashlib
 import imagehash
+import itertools
+import multiprocessing
+import numpy as np
 import os
+import sqlite3
+import sys
+import time
 
 from collections import defaultdict
 from PIL import Image
@@ -34,40 +67,410 @@ def getImgs(d):
     return imgClasses
 
 
-def getHash(imgPath):
-    """Get the hash of an image, and catch exceptions if the image
-    file is corrupted."""
+# Thumbnail (width, height) each kind of hash is computed from, as in
+# imagehash's average_hash, dhash and phash.
+thumbSizes = {'average': (8, 8), 'difference': (9, 8), 'perceptual': (32, 32)}
+
+
+def getThumb(imgPath, size=(8, 8)):
+    """Get a grayscale thumbnail of an image as an array, and catch
+    exceptions if the image file is corrupted.
+
+    JPEGs are decoded at a reduced scale, down to 8 times `size`, instead
+    of decoding every pixel only to throw most of them away."""
     try:
-        return imagehash.average_hash(Image.open(imgPath))
+        img = Image.open(imgPath)
+        img.draft('L', (size[0] * 8, size[1] * 8))
+        return np.asarray(img.convert('L').resize(size, Image.LANCZOS))
     except:
         return None
 
 
-def runOnClass(args, imgs):
-    """Find and remove duplicates within an image class."""
+def hashThumbs(thumbs, kind='average'):
+    """Hash a batch of thumbnails from `getThumb` at once.
+
+    Gives the same hashes as imagehash's hash of the same kind on each
+    thumbnail, and None for the None thumbnails of corrupted images."""
+    ok = [i for i, thumb in enumerate(thumbs) if thumb is not None]
+    hashes = [None] * len(thumbs)
+    if not ok:
+        return hashes
+    pixels = np.stack([thumbs[i] for i in ok])
+    if kind == 'average':
+        diffs = pixels > pixels.mean(axis=(1, 2), keepdims=True)
+    elif kind == 'difference':
+        diffs = pixels[:, :, 1:] > pixels[:, :, :-1]
+    else:
+        import scipy.fftpack
+        dct = scipy.fftpack.dct(scipy.fftpack.dct(pixels, axis=1), axis=2)
+        lowFreqs = dct[:, :8, :8]
+        medians = np.median(lowFreqs.reshape(len(ok), -1), axis=1)
+        diffs = lowFreqs > medians[:, None, None]
+    for i, diff in zip(ok, diffs):
+        hashes[i] = imagehash.ImageHash(diff)
+    return hashes
+
+
+def batchHashes(thumbs, kind='average', batchSize=256):
+    """Yield the hashes of the thumbnails from an iterator, hashing
+    `batchSize` of them at a time."""
+    while True:
+        batch = list(itertools.islice(thumbs, batchSize))
+        if not batch:
+            return
+        yield from hashThumbs(batch, kind)
+
+
+def getHash(imgPath, kind='average'):
+    """Get the hash of an image, or None if the image file is
+    corrupted."""
+    return hashThumbs([getThumb(imgPath, thumbSizes[kind])], kind)[0]
+
+
+def checkHashes(imgs, kind='average'):
+    """Compare the hashes of `imgs` from `hashThumbs` to imagehash's.
+
+    Returns the images whose hashes differ from imagehash's on the same
+    thumbnails, which checks the hashing, and `(image, bits)` pairs for
+    those differing from imagehash's on the full image, which also
+    measures the drift from decoding JPEGs at a reduced scale."""
+    imagehashFuncs = {'average': imagehash.average_hash,
+                      'difference': imagehash.dhash,
+                      'perceptual': imagehash.phash}
+    thumbs = [getThumb(img, thumbSizes[kind]) for img in imgs]
+    wrong = []
+    drifted = []
+    for img, thumb, imgHash in zip(imgs, thumbs, hashThumbs(thumbs, kind)):
+        if thumb is None:
+            continue
+        if imgHash != imagehashFuncs[kind](Image.fromarray(thumb)):
+            wrong.append(img)
+        with Image.open(img) as full:
+            bits = imgHash - imagehashFuncs[kind](full)
+        if bits:
+            drifted.append((img, bits))
+    return wrong, drifted
+
+
+def fileDigest(path, limit=None, blockSize=1 << 16):
+    """Get the sha256 sum of a file, or of its first `limit` bytes,
+    reading it a block at a time."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while limit is None or limit > 0:
+            block = f.read(blockSize if limit is None
+                           else min(blockSize, limit))
+            if not block:
+                break
+            h.update(block)
+            if limit is not None:
+                limit -= len(block)
+    return h.hexdigest()
+
+
+def findCopies(imgs, headSize=4096):
+    """Find the byte-identical copies among `imgs`, returning a dict from
+    each copy to the first image with the same content.
+
+    Images are grouped by size, then by the sum of their first
+    `headSize` bytes, and only the images still grouped are read in full,
+    so most images are never opened."""
+    def split(groups, key):
+        for group in groups:
+            if len(group) < 2:
+                continue
+            d = defaultdict(list)
+            for img in group:
+                try:
+                    d[key(img)].append(img)
+                except OSError:
+                    pass
+            yield from d.values()
+
+    groups = [imgs]
+    for key in (os.path.getsize, lambda img: fileDigest(img, headSize),
+                fileDigest):
+        groups = split(groups, key)
+
+    copies = {}
+    for group in groups:
+        for img in group[1:]:
+            copies[img] = group[0]
+    return copies
+
+
+class HashCache:
+    """A SQLite cache of image hashes of the given `kind`.
+
+    Entries are keyed on the image's path relative to `root` and are only
+    used while its size, mtime and inode are unchanged. Entries for
+    images that weren't looked up are deleted by `close`.
+    """
+    missing = object()
+
+    def __init__(self, dbPath, root, kind='average'):
+        self.root = root
+        self.table = "{}_hashes".format(kind)
+        self.db = sqlite3.connect(dbPath)
+        self.db.execute("CREATE TABLE IF NOT EXISTS {} (path TEXT PRIMARY "
+                        "KEY, size INTEGER, mtime INTEGER, inode INTEGER, "
+                        "hash TEXT)".format(self.table))
+        self.entries = {row[0]: row[1:] for row in self.db.execute(
+            "SELECT path, size, mtime, inode, hash FROM {}".format(
+                self.table))}
+        self.seen = {}  # Image path -> (relative path, identity).
+        self.updates = []
+
+    def get(self, imgPath):
+        """Return the cached hash of `imgPath`, which is None if it
+        couldn't be read, or `HashCache.missing`."""
+        path = os.path.relpath(imgPath, self.root)
+        try:
+            st = os.stat(imgPath)
+        except OSError:
+            return self.missing
+        identity = (st.st_size, st.st_mtime_ns, st.st_ino)
+        self.seen[imgPath] = (path, identity)
+        entry = self.entries.get(path)
+        if entry is None or entry[:3] != identity:
+            return self.missing
+        return imagehash.hex_to_hash(entry[3]) if entry[3] else None
+
+    def size(self, imgPath):
+        """Get the size `imgPath` had when it was looked up, or None."""
+        seen = self.seen.get(imgPath)
+        return seen[1][0] if seen else None
+
+    def put(self, imgPath, imgHash):
+        if imgPath in self.seen:
+            path, identity = self.seen[imgPath]
+            hexHash = str(imgHash) if imgHash else None
+            self.updates.append((path,) + identity + (hexHash,))
+            if len(self.updates) >= 10000:
+                self.flush()
+
+    def flush(self):
+        self.db.executemany("INSERT OR REPLACE INTO {} VALUES "
+                            "(?, ?, ?, ?, ?)".format(self.table),
+                            self.updates)
+        self.db.commit()
+        self.updates = []
+
+    def close(self):
+        self.flush()
+        seen = set(path for path, _ in self.seen.values())
+        self.db.executemany(
+            "DELETE FROM {} WHERE path = ?".format(self.table),
+            [(path,) for path in self.entries if path not in seen])
+        self.db.commit()
+        self.db.close()
+
+
+def hashImgs(imgs, pool=None, cache=None, kind='average'):
+    """Yield the `kind` hashes of `imgs` in order.
+
+    Hashes found in `cache` are used as is. Images that aren't cached
+    and are byte-identical copies of another image get its hash
+    without being decoded; only they and the cached images of the same
+    size are checked for copies, so an unchanged rerun reads no images.
+    The thumbnails of the rest are decoded in `pool` if given and hashed
+    in batches, printing the throughput to stderr, and the new hashes
+    are added to `cache`.
+    """
+    imgs = list(imgs)
+    known = [cache.get(img) if cache else HashCache.missing for img in imgs]
+    knownHashes = dict(zip(imgs, known))
+    misses = [img for img in imgs if knownHashes[img] is HashCache.missing]
+    candidates = misses
+    if cache and misses:
+        # Cached images go first, so they're the originals of the copies
+        # they have.
+        sizes = {cache.size(img) for img in misses}
+        cached = [img for img in imgs
+                  if knownHashes[img] is not HashCache.missing]
+        candidates = [img for img in cached
+                      if cache.size(img) in sizes] + misses
+    copies = {img: original
+              for img, original in findCopies(candidates).items()
+              if knownHashes[img] is HashCache.missing}
+    if copies:
+        sys.stderr.write("Found {} byte-identical copies.\n".format(
+            len(copies)))
+    # The hashes of uncached originals are filled in as they're hashed,
+    # which is before their copies since they come first in `imgs`.
+    originals = {img: knownHashes[img] for img in copies.values()}
+    todo = [img for img in misses if img not in copies]
+    decode = functools.partial(getThumb, size=thumbSizes[kind])
+    if pool:
+        thumbs = pool.imap(decode, todo, chunksize=16)
+    else:
+        thumbs = map(decode, todo)
+    hashes = batchHashes(thumbs, kind)
+    beginTime = time.time()
+    lastPrint = beginTime
+    n = 0
+    for img, imgHash in zip(imgs, known):
+        if imgHash is HashCache.missing and img in copies:
+            imgHash = originals[copies[img]]
+            if cache:
+                cache.put(img, imgHash)
+        elif imgHash is HashCache.missing:
+            imgHash = next(hashes)
+            if cache:
+                cache.put(img, imgHash)
+            n += 1
+            now = time.time()
+            if now - lastPrint >= 5:
+                lastPrint = now
+                sys.stderr.write("Hashed {} images in {:.2f} seconds. "
+                                 "{:.2f} images/second.\n".format(
+                                     n, now - beginTime,
+                                     n / (now - beginTime)))
+        if img in originals:
+            originals[img] = imgHash
+        yield imgHash
+
+
+class HammingIndex:
+    """An index of integer hashes for finding those within `maxDistance`
+    bits of a query, using multi-index hashing from Norouzi, Punjani and
+    Fleet, "Fast Search in Hamming Space with Multi-Index Hashing".
+
+    Hashes are split into `m` chunks, each indexed in its own table. Two
+    hashes within `maxDistance` bits have some chunk within
+    `maxDistance // m` bits, so only the hashes in the table buckets
+    that close to the query's chunks are compared in full. Chunks are
+    about log2(`size`) bits wide, so buckets stay small for an index
+    of `size` hashes.
+    """
+
+    def __init__(self, maxDistance, bits=64, size=1 << 16):
+        self.maxDistance = maxDistance
+        m = max(1, min(maxDistance + 1, bits // max(8, size.bit_length())))
+        bounds = [bits * i // m for i in range(m + 1)]
+        self.chunks = [(lo, (1 << (hi - lo)) - 1)
+                       for lo, hi in zip(bounds, bounds[1:])]
+        # The values within `maxDistance // m` bits of 0 in each chunk.
+        radius = maxDistance // m
+        self.probes = []
+        for lo, mask in self.chunks:
+            width = mask.bit_length()
+            self.probes.append([sum(1 << b for b in flipped)
+                                for r in range(radius + 1)
+                                for flipped in itertools.combinations(
+                                    range(width), r)])
+        self.tables = [defaultdict(list) for _ in self.chunks]
+        self.hashes = []
+
+    def add(self, h):
+        for (shift, mask), table in zip(self.chunks, self.tables):
+            table[(h >> shift) & mask].append(len(self.hashes))
+        self.hashes.append(h)
+
+    def query(self, h):
+        """Return the indexes of the added hashes within `maxDistance`
+        bits of `h`."""
+        checked = set()
+        found = []
+        for (shift, mask), table, probes in zip(self.chunks, self.tables,
+                                                self.probes):
+            chunk = (h >> shift) & mask
+            for probe in probes:
+                for i in table.get(chunk ^ probe, ()):
+                    if i not in checked:
+                        checked.add(i)
+                        if bin(h ^ self.hashes[i]).count('1') <= \
+                                self.maxDistance:
+                            found.append(i)
+        return found
+
+
+def groupImgs(imgs, hashes, maxDistance=0):
+    """Group `imgs` by their `hashes`, returning `(hash, imgs)` pairs.
+
+    With `maxDistance`, groups whose hashes are within that many bits of
+    each other are merged, transitively.
+    """
     d = defaultdict(list)
-    for imgPath in imgs:
-        imgHash = getHash(imgPath)
+    for imgPath, imgHash in zip(imgs, hashes):
         if imgHash:
-            d[imgHash].append(imgPath)
+            # Hex strings take a fraction of the memory of `ImageHash`es.
+            d[str(imgHash)].append(imgPath)
+    if not maxDistance or not d:
+        return list(d.items())
+
+    distinct = list(d)
+    parent = list(range(len(distinct)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    index = HammingIndex(maxDistance, 4 * len(distinct[0]), len(distinct))
+    for i, imgHash in enumerate(distinct):
+        h = int(str(imgHash), 16)
+        for j in index.query(h):
+            parent[find(i)] = find(j)
+        index.add(h)
+
+    groups = defaultdict(list)
+    for i in range(len(distinct)):
+        groups[find(i)].append(i)
+    return [(distinct[ids[0]], [img for i in ids for img in d[distinct[i]]])
+            for ids in groups.values()]
+
+
+def getClass(root, imgPath):
+    """Get the class of an image, its directory relative to `root`."""
+    return os.path.relpath(os.path.dirname(imgPath), root)
+
+
+def keepImg(imgs, keep='largest', preferred=(), root='.'):
+    """Choose which of a group of duplicate images to keep.
+
+    `keep` is 'largest', 'oldest', or 'class' to keep the image whose
+    class comes first in `preferred`, breaking ties by size."""
+    if keep == 'oldest':
+        return min(imgs, key=os.path.getmtime)
+    if keep == 'class':
+        rank = {c: i for i, c in enumerate(preferred)}
+        return min(imgs, key=lambda img: (
+            rank.get(getClass(root, img), len(rank)), -os.path.getsize(img)))
+    return max(imgs, key=os.path.getsize)
+
+
+def runOnClass(args, imgs, hashes=None):
+    """Find and remove duplicates within an image class.
+
+    `hashes` are the hashes of `imgs`, which are computed here if not
+    given."""
+    if hashes is None:
+        hashes = map(functools.partial(getHash, kind=args.hash), imgs)
 
     numFound = 0
-    for imgHash, imgs in d.items():
+    for imgHash, imgs in groupImgs(imgs, hashes, args.maxDistance):
         if len(imgs) > 1:
             print("{}: {}".format(imgHash, " ".join(imgs)))
             numFound += len(imgs) - 1  # Keep a single image.
 
+            classes = {getClass(args.inplaceDir, img) for img in imgs}
+            if len(classes) > 1:
+                print("Across classes: {}".format(", ".join(sorted(classes))))
+
             if args.delete:
-                largestImg = max(imgs, key=os.path.getsize)
-                print("Keeping {}.".format(largestImg))
-                imgs.remove(largestImg)
+                keptImg = keepImg(imgs, args.keep, args.prefer,
+                                  args.inplaceDir)
+                print("Keeping {}.".format(keptImg))
+                imgs.remove(keptImg)
                 for img in imgs:
                     os.remove(img)
 
             if args.sha256:
                 print("")
                 for img in imgs:
-                    print(hashlib.sha256(open(img, 'rb').read()).hexdigest())
+                    print(fileDigest(img))
                 print("")
     return numFound
 
@@ -81,9 +484,74 @@ if __name__ == '__main__':
                         "of just listing them.")
     parser.add_argument('--sha256', action='store_true',
                         help="Show sha256 sum for duplicate images")
+    parser.add_argument('--global', action='store_true', dest='globalIndex',
+                        help="Find duplicates across the whole tree instead "
+                        "of within each class.")
+    parser.add_argument('--keep', choices=['largest', 'oldest', 'class'],
+                        default='largest',
+                        help="Which duplicate image --delete keeps.")
+    parser.add_argument('--prefer', action='append', default=[],
+                        metavar='CLASS',
+                        help="With --keep class, keep images in this class "
+                        "(relative to inplaceDir) first. Can be repeated, "
+                        "most preferred first.")
+    parser.add_argument('--hash', choices=sorted(thumbSizes),
+                        default='average',
+                        help="Kind of image hash to compare.")
+    parser.add_argument('--check-hashes', action='store_true',
+                        dest='checkHashes',
+                        help="Check the hashes against imagehash's on the "
+                        "same thumbnails, report how far they are from "
+                        "imagehash's on the full images, and exit.")
+    parser.add_argument('--max-distance', type=int, default=0,
+                        dest='maxDistance', metavar='N',
+                        help="Also treat images whose hashes differ in at "
+                        "most N bits as duplicates.")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help="Number of processes to hash images with.")
+    parser.add_argument('--cache', type=str,
+                        help="Hash cache database. Default: "
+                        "<inplaceDir>/.remove-duplicates-cache.sqlite")
+    parser.add_argument('--no-cache', action='store_true', dest='noCache',
+                        help="Don't read or write the hash cache.")
     args = parser.parse_args()
+    if args.keep == 'class' and not args.prefer:
+        parser.error("--keep class needs at least one --prefer class.")
+
+    if args.checkHashes:
+        imgs = list(itertools.chain.from_iterable(getImgs(args.inplaceDir)))
+        wrong, drifted = checkHashes(imgs, args.hash)
+        for img in wrong:
+            print("Hash differs from imagehash's: {}".format(img))
+        for img, bits in drifted:
+            print("Hash is {} bits from imagehash's on the full image: "
+                  "{}".format(bits, img))
+        print("Checked {} images, {} differ, {} differ from the full "
+              "images by up to {} bits.".format(
+                  len(imgs), len(wrong), len(drifted),
+                  max([bits for _, bits in drifted], default=0)))
+        sys.exit(1 if wrong else 0)
+
+    cache = None
+    if not args.noCache:
+        cache = HashCache(args.cache or os.path.join(
+            args.inplaceDir, '.remove-duplicates-cache.sqlite'),
+            args.inplaceDir, args.hash)
+
+    imgClasses = getImgs(args.inplaceDir)
+    if args.globalIndex:
+        imgClasses = [list(itertools.chain.from_iterable(imgClasses))]
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    hashes = hashImgs(itertools.chain.from_iterable(imgClasses), pool, cache,
+                      args.hash)
 
     numFound = 0
-    for imgClass in getImgs(args.inplaceDir):
-        numFound += runOnClass(args, imgClass)
+    for imgClass in imgClasses:
+        numFound += runOnClass(args, imgClass,
+                               itertools.islice(hashes, len(imgClass)))
+    if pool:
+        pool.close()
+        pool.join()
+    if cache:
+        cache.close()
     print("\n\nFound {} total duplicate images.".format(numFound))
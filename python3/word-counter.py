@@ -4,7 +4,7 @@ __author__ = ['[Brandon Amos](http://bamos.github.io)']
 __date__ = '2014.11.7'
 
 """
-Count work frequencies within a file.
+Count work frequencies within files.
 
 ```
 $ word-counter.py shakespeare.md --numWords 4 --maxTuples 3
@@ -27,37 +27,542 @@ $ word-counter.py shakespeare.md --numWords 4 --maxTuples 3
     18: 'comes here? enter'
     14: 'duke's palace enter'
 ```
+
+The file is read in chunks of `--chunkSize` bytes (optionally through
+`mmap`), so memory use depends on the number of distinct n-grams and
+not on the size of the file. `--stats` prints the peak memory use.
+
+Any number of files and directories can be given. Files are split into
+shards of about `--shardSize` bytes at whitespace and the shards are
+counted by `--jobs` processes, fixing up the n-grams spanning shards so
+the output is the same as a serial run. N-grams never span two files.
+
+With `--approxMemory MB`, each window keeps a fixed number of
+approximate counters instead of counting every distinct n-gram,
+sized to fit in about `MB` megabytes in total. The budget is split
+between the totals and the shards being counted at once, of which at
+most `--jobs` are in flight.
+Each count is printed with how much it may be overestimated by.
+
+With `--index PATH`, the counts for each file are saved to `PATH` along
+with the file's size, mtime and how far it was read. Later runs reuse
+them for unchanged files and only read what was appended to files that
+grew. The index counts every n-gram regardless of `--minWordLength`,
+so any `--numWords` and `--minWordLength` can be reported from it.
 """
 
-from collections import Counter
+from collections import Counter, deque
+from itertools import compress
+from operator import itemgetter
 import argparse
+import functools
+import gzip
+import hashlib
+import heapq
+import locale
+import mmap
+import multiprocessing
+import os
+import pickle
 import re
-from toolz.itertoolz import sliding_window
+import resource
+import sys
+import time
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--numWords', type=int, default=10)
 parser.add_argument('--maxTuples', type=int, default=4)
 parser.add_argument('--minWordLength', type=int, default=5)
-parser.add_argument('file', type=str)
-args = parser.parse_args()
+parser.add_argument('--chunkSize', type=int, default=1 << 20,
+                    help="Bytes to read at a time.")
+parser.add_argument('--mmap', action='store_true',
+                    help="Read the file through mmap.")
+parser.add_argument('--stats', action='store_true',
+                    help="Print time and peak memory use to stderr.")
+parser.add_argument('--jobs', type=int, default=1,
+                    help="Processes to count shards with.")
+parser.add_argument('--shardSize', type=int, default=1 << 26,
+                    help="Approximate bytes per shard.")
+parser.add_argument('--approxMemory', type=float,
+                    help="Count approximately in about this many megabytes "
+                    "in total, split between the totals and the shards "
+                    "being counted.")
+parser.add_argument('--index', type=str,
+                    help="Index file to keep counts in between runs.")
+parser.add_argument('files', type=str, nargs='+', metavar='file',
+                    help="Files, or directories to read every file in.")
+
+url_re = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+
+# ASCII characters `str.split` treats as whitespace. In an ASCII-compatible
+# encoding such as UTF-8 these bytes never occur inside a multibyte
+# character, so a chunk can be cut after any of them.
+whitespace = [bytes([c]) for c in b' \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f']
+
+
+def read_words(path, chunk_size=1 << 20, use_mmap=False, start=0, end=None):
+    """Yield the lowercased words of `path` a chunk at a time.
+
+    Each chunk is cut after its last whitespace byte and the partial
+    word after it is carried over to the next chunk, so the words are
+    the same as `re.findall(r'\\S+', open(path).read().lower())`.
+    Only the bytes from `start` to `end` are read.
+    """
+    encoding = locale.getpreferredencoding(False)
+    with open(path, 'rb') as f:
+        size = f.seek(0, 2)
+        end = size if end is None else min(end, size)
+        if use_mmap and size > 0:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            buf = f
+        buf.seek(start)
+        pos = start
+        rest = b''
+        while pos < end:
+            chunk = buf.read(min(chunk_size, end - pos))
+            if not chunk:
+                break
+            pos += len(chunk)
+            chunk = rest + chunk
+            cut = max(chunk.rfind(c) for c in whitespace) + 1
+            rest = chunk[cut:]
+            if cut:
+                yield chunk[:cut].decode(encoding).lower().split()
+        if rest:
+            yield rest.decode(encoding).lower().split()
+        if buf is not f:
+            buf.close()
+
+
+def find_files(paths):
+    """Yield `paths`, replacing directories with the files under them."""
+    for path in paths:
+        if os.path.isdir(path):
+            for dirname, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    yield os.path.join(dirname, filename)
+        else:
+            yield path
+
+
+def shard_file(path, shard_size):
+    """Split `path` into `(path, start, end)` byte ranges of at least
+    `shard_size` bytes, each ending just after a whitespace byte."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        while bounds[-1] + shard_size < size:
+            pos = f.seek(bounds[-1] + shard_size)
+            while True:
+                block = f.read(1 << 16)
+                cuts = [i for i in (block.find(c) for c in whitespace) if i >= 0]
+                if not block or cuts:
+                    break
+                pos += len(block)
+            if not cuts or pos + min(cuts) + 1 >= size:
+                break
+            bounds.append(pos + min(cuts) + 1)
+    bounds.append(size)
+    return [(path, start, end) for start, end in zip(bounds, bounds[1:])]
+
+
+class SpaceSaving:
+    """Approximate counts of the most frequent items in fixed memory.
+
+    This is the Space-Saving algorithm from Metwally, Agrawal and El
+    Abbadi, "Efficient Computation of Frequent and Top-k Elements in Data
+    Streams". At most `capacity` items are tracked. When a new item
+    arrives and the table is full, it replaces the item with the smallest
+    count and inherits that count as its error, so a count is never too
+    low and is too high by at most `error(item)`. Every item occurring
+    more than `total / capacity` times is tracked.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = max(capacity, 1)
+        self.counts = {}  # item -> [count, error]
+        # (count, item) for every tracked item. Counts in the heap may be
+        # lower than the real ones, which are fixed up when they reach
+        # the top.
+        self.heap = []
+
+    def add(self, item):
+        entry = self.counts.get(item)
+        if entry is not None:
+            entry[0] += 1
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = [1, 0]
+            heapq.heappush(self.heap, (1, item))
+        else:
+            count, victim = self.heap[0]
+            while self.counts[victim][0] != count:
+                heapq.heapreplace(self.heap, (self.counts[victim][0], victim))
+                count, victim = self.heap[0]
+            del self.counts[victim]
+            self.counts[item] = [count + 1, count]
+            heapq.heapreplace(self.heap, (count + 1, item))
+
+    def update(self, items):
+        if isinstance(items, SpaceSaving):
+            self.merge(items)
+        else:
+            counts = self.counts
+            for item in items:
+                entry = counts.get(item)
+                if entry is not None:
+                    entry[0] += 1
+                else:
+                    self.add(item)
+
+    def min_count(self):
+        """The count an untracked item may have had, or 0 if nothing has
+        been dropped yet."""
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(count for count, _ in self.counts.values())
+
+    def merge(self, other):
+        """Add the counts from another summary.
+
+        Following Agarwal et al., "Mergeable Summaries", an item missing
+        from one summary is assumed to have had that summary's minimum
+        count, which keeps the counts from being too low.
+        """
+        mins = (self.min_count(), other.min_count())
+        merged = {}
+        for item in list(self.counts) + list(other.counts):
+            if item not in merged:
+                a = self.counts.get(item, (mins[0], mins[0]))
+                b = other.counts.get(item, (mins[1], mins[1]))
+                merged[item] = [a[0] + b[0], a[1] + b[1]]
+        top = set(item for item, _ in heapq.nlargest(
+            self.capacity, merged.items(), key=lambda kv: kv[1][0]))
+        self.counts = {item: merged[item] for item in merged if item in top}
+        self.heap = [(entry[0], item) for item, entry in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def most_common(self, n):
+        return [(item, entry[0]) for item, entry in heapq.nlargest(
+            n, self.counts.items(), key=lambda kv: kv[1][0])]
+
+    def error(self, item):
+        return self.counts[item][1]
+
+
+# A rough size of one SpaceSaving entry for an n-gram: the tuple, its
+# strings, the dict slot, the [count, error] list and the heap entry.
+def approx_entry_bytes(n):
+    return 320 + 72 * n
+
+
+class NgramCounter:
+    """Count the n-grams of every size up to `max_tuples` in one pass.
+
+    Words are fed in order with `update`, and each distinct word is
+    checked against the length and URL filters only once.
+    `counts[n - 1]` is the `Counter` of n-grams made only of valid words,
+    in the same order `Counter(sliding_window(n, words))` would see them.
+    """
+
+    def __init__(self, max_tuples, min_word_length, approx_memory=None):
+        if approx_memory:
+            # Split the budget evenly between the windows.
+            budget = approx_memory * (1 << 20) / max(max_tuples, 1)
+            self.counts = [SpaceSaving(int(budget / approx_entry_bytes(n)))
+                           for n in range(1, max_tuples + 1)]
+        else:
+            self.counts = [Counter() for _ in range(max_tuples)]
+        self.min_word_length = min_word_length
+        self.valid = {}
+        # The last `max_tuples - 1` words fed and, for each, the number
+        # of consecutive valid words ending there.
+        self.tail = []
+        self.tail_runs = []
+
+    def is_valid(self, word):
+        return len(word) >= self.min_word_length and not url_re.search(word)
 
+    def update(self, words):
+        tokens = self.tail + words
+        runs = self.tail_runs[:]
+        run = runs[-1] if runs else 0
+        valid = self.valid
+        for word in words:
+            v = valid.get(word)
+            if v is None:
+                v = valid[word] = self.is_valid(word)
+            run = run + 1 if v else 0
+            runs.append(run)
 
-def filter_func(tup):
-    for word in tup:
-        if len(word) < args.minWordLength:
-            return False
-        elif re.search('http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', word):
-            return False
-    return True
+        # Count the windows ending in `words`; the ones ending in the tail
+        # were counted by the previous update.
+        for n, counts in enumerate(self.counts, 1):
+            start = max(0, len(self.tail) - n + 1)
+            grams = zip(*[tokens[start + k:] for k in range(n)])
+            counts.update(compress(grams, [r >= n for r in runs[start + n - 1:]]))
 
+        keep = max(len(self.counts) - 1, 0)
+        self.tail = tokens[-keep:] if keep else []
+        self.tail_runs = runs[-keep:] if keep else []
 
-def filtered_window(seq, n):
-    return filter(filter_func, sliding_window(n, seq))
+    def update_junction(self, before, after):
+        """Count the n-grams starting in `before` and ending in `after`,
+        the words on either side of a shard boundary."""
+        tokens = before + after
+        valid = [self.is_valid(word) for word in tokens]
+        for n, counts in enumerate(self.counts, 1):
+            for i in range(max(0, len(before) - n + 1), len(before)):
+                if i + n <= len(tokens) and all(valid[i:i + n]):
+                    counts.update([tuple(tokens[i:i + n])])
 
-with open(args.file, 'r') as f:
-    content = f.read().replace('\n', ' ').lower()
-    words = re.findall(r'\S+', content)
-    for i in range(1, args.maxTuples + 1):
+    def merge(self, counts):
+        for total, shard in zip(self.counts, counts):
+            total.update(shard)
+
+
+def count_shard(shard, max_tuples, min_word_length, chunk_size, use_mmap,
+                approx_memory):
+    """Count the n-grams inside a shard.
+
+    Returns the counts, the first and last `max_tuples - 1` words of the
+    shard for fixing up the n-grams spanning its boundaries, and the
+    number of words.
+    """
+    keep = max(max_tuples - 1, 0)
+    path, start, end = shard
+    counter = NgramCounter(max_tuples, min_word_length, approx_memory)
+    head = []
+    num_words = 0
+    for words in read_words(path, chunk_size, use_mmap, start, end):
+        if len(head) < keep:
+            head.extend(words[:keep - len(head)])
+        counter.update(words)
+        num_words += len(words)
+    return counter.counts, head, counter.tail, num_words
+
+
+def bounded_imap(pool, func, items, window):
+    """Like `pool.imap`, but with at most `window` items submitted and
+    not yet consumed, so finished results don't pile up in memory."""
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def count_files(args):
+    """Count the n-grams in `args.files`, returning an `NgramCounter`
+    holding the totals and the number of words."""
+    shards = [shard for path in find_files(args.files)
+              for shard in shard_file(path, args.shardSize)]
+    jobs = max(min(args.jobs, len(shards)), 1)
+    approx_memory = None
+    if args.approxMemory:
+        # The totals and one summary per shard in flight.
+        approx_memory = args.approxMemory / (jobs + 1)
+    count = functools.partial(count_shard, max_tuples=args.maxTuples,
+                              min_word_length=args.minWordLength,
+                              chunk_size=args.chunkSize, use_mmap=args.mmap,
+                              approx_memory=approx_memory)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = bounded_imap(pool, count, shards, jobs)
+    else:
+        pool = None
+        results = map(count, shards)
+
+    keep = max(args.maxTuples - 1, 0)
+    total = NgramCounter(args.maxTuples, args.minWordLength, approx_memory)
+    context = []  # The last words before the current shard in its file.
+    num_words = 0
+    for (path, start, end), (counts, head, tail, n) in zip(shards, results):
+        if start == 0:
+            context = []
+        total.update_junction(context, head)
+        total.merge(counts)
+        context = (context + tail)[-keep:] if keep else []
+        num_words += n
+    if pool:
+        pool.close()
+        pool.join()
+    return total, num_words
+
+
+def index_state(max_tuples):
+    """The index entry for a file that hasn't been read yet."""
+    return {'size': 0, 'mtime': 0, 'offset': 0, 'fingerprint': None,
+            'counts': [Counter() for _ in range(max_tuples)],
+            'tail': [], 'tail_runs': [],
+            'pending': [Counter() for _ in range(max_tuples)]}
+
+
+def fingerprint(path, offset):
+    """Hash the 4 KiB before `offset` to notice files that were rewritten
+    rather than appended to."""
+    start = max(0, offset - 4096)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+
+def find_last_whitespace(path, end):
+    """Return the offset just after the last whitespace byte before `end`,
+    or 0 if there is none."""
+    with open(path, 'rb') as f:
+        pos = end
+        while pos > 0:
+            start = max(0, pos - (1 << 16))
+            f.seek(start)
+            block = f.read(pos - start)
+            cut = max(block.rfind(c) for c in whitespace)
+            if cut >= 0:
+                return start + cut + 1
+            pos = start
+    return 0
+
+
+def count_appended(job, max_tuples, chunk_size, use_mmap):
+    """Count the n-grams ending between `start` and `end` of a file,
+    continuing from the last words of the previous run.
+
+    The words after the last whitespace may be the start of a longer
+    word appended later, so the n-grams ending in them are returned
+    separately as `pending` and the returned offset stops before them.
+    """
+    path, start, end, tail, tail_runs = job
+    committed = max(start, find_last_whitespace(path, end))
+    counter = NgramCounter(max_tuples, 0)
+    counter.tail, counter.tail_runs = tail, tail_runs
+    num_words = 0
+    for words in read_words(path, chunk_size, use_mmap, start, committed):
+        counter.update(words)
+        num_words += len(words)
+    pending = NgramCounter(max_tuples, 0)
+    pending.tail, pending.tail_runs = counter.tail, counter.tail_runs
+    for words in read_words(path, chunk_size, use_mmap, committed, end):
+        pending.update(words)
+        num_words += len(words)
+    return (counter.counts, counter.tail, counter.tail_runs, pending.counts,
+            committed, num_words)
+
+
+def count_indexed(args):
+    """Count the n-grams in `args.files` using the index in `args.index`,
+    reading only the bytes appended since it was saved."""
+    index = None
+    if os.path.exists(args.index):
+        with gzip.open(args.index, 'rb') as f:
+            index = pickle.load(f)
+    if index is None or index['max_tuples'] < args.maxTuples:
+        index = {'max_tuples': args.maxTuples, 'files': {}}
+    max_tuples = index['max_tuples']
+    states = index['files']
+
+    paths = [os.path.abspath(path) for path in find_files(args.files)]
+    jobs = []
+    for path in paths:
+        st = os.stat(path)
+        state = states.get(path)
+        if state and (state['size'], state['mtime']) == \
+                (st.st_size, st.st_mtime_ns):
+            continue
+        if not state or st.st_size < state['offset'] or \
+                fingerprint(path, state['offset']) != state['fingerprint']:
+            state = states[path] = index_state(max_tuples)
+        state['size'], state['mtime'] = st.st_size, st.st_mtime_ns
+        jobs.append((path, state['offset'], st.st_size, state['tail'],
+                     state['tail_runs']))
+
+    count = functools.partial(count_appended, max_tuples=max_tuples,
+                              chunk_size=args.chunkSize, use_mmap=args.mmap)
+    if args.jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(count, jobs)
+    else:
+        pool = None
+        results = map(count, jobs)
+    num_words = 0
+    changed = bool(jobs)
+    for job, (counts, tail, tail_runs, pending, offset, n) in zip(jobs, results):
+        state = states[job[0]]
+        for total, old in zip(state['counts'], state['pending']):
+            for gram, c in old.items():
+                total[gram] -= c
+                if total[gram] <= 0:
+                    del total[gram]
+        for total, new, new_pending in zip(state['counts'], counts, pending):
+            total.update(new)
+            total.update(new_pending)
+        state.update(tail=tail, tail_runs=tail_runs, pending=pending,
+                     offset=offset,
+                     fingerprint=fingerprint(job[0], offset))
+        num_words += n
+    if pool:
+        pool.close()
+        pool.join()
+
+    for path in list(states):
+        if not os.path.exists(path):
+            del states[path]
+            changed = True
+    if changed:
+        tmp = args.index + '.tmp'
+        with gzip.open(tmp, 'wb', compresslevel=1) as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, args.index)
+
+    total = NgramCounter(args.maxTuples, 0)
+    for path in paths:
+        total.merge(states[path]['counts'])
+    return total, num_words
+
+
+def most_common(counts, num_words, min_word_length):
+    """Like `counts.most_common(num_words)`, but only for n-grams whose
+    words all have at least `min_word_length` characters."""
+    if not min_word_length:
+        return counts.most_common(num_words)
+    return heapq.nlargest(num_words, [
+        kv for kv in counts.items() if min(map(len, kv[0])) >= min_word_length
+    ], key=itemgetter(1))
+
+
+def print_counts(counter, num_words, min_word_length=0):
+    for i, counts in enumerate(counter.counts, 1):
         print("\n=== Sliding Window: {} ===".format(i))
-        for tup in Counter(filtered_window(words, i)).most_common(args.numWords):
-            print("    {}: '{}'".format(tup[1], " ".join(tup[0])))
+        for tup in most_common(counts, num_words, min_word_length):
+            if isinstance(counts, SpaceSaving):
+                print("    {}: '{}' (error <= {})".format(
+                    tup[1], " ".join(tup[0]), counts.error(tup[0])))
+            else:
+                print("    {}: '{}'".format(tup[1], " ".join(tup[0])))
+
+
+def print_stats(num_words, begin_time):
+    elapsed = time.time() - begin_time
+    # ru_maxrss is in kilobytes on Linux and bytes on OS X.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10)
+    sys.stderr.write("Counted {} words in {:.2f} seconds. "
+                     "Peak memory: {:.1f} MB.\n".format(
+                         num_words, elapsed, peak_mb))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.index and args.approxMemory:
+        parser.error("--index can't be used with --approxMemory.")
+    begin_time = time.time()
+    if args.index:
+        counter, num_words = count_indexed(args)
+        print_counts(counter, args.numWords, args.minWordLength)
+    else:
+        counter, num_words = count_files(args)
+        print_counts(counter, args.numWords)
+    if args.stats:
+        print_stats(num_words, begin_time)